@@ -0,0 +1,199 @@
+"""Portfolio performance computed with NumPy over a user's whole history
+
+History is loaded once into column arrays and every figure is derived with
+array operations, so large accounts cost one pass over their rows plus a
+handful of vectorized steps. Cost basis follows the average cost method:
+a sale realizes its proceeds minus the average cost of the shares sold.
+Daily prices come from the 7-day series cached with each quote, so the
+time-weighted return and the contribution chart cover that window, while
+realized P&L and the money-weighted return cover the whole history.
+"""
+
+import datetime
+
+import numpy as np
+
+
+SECONDS_PER_YEAR = 365.25 * 86400
+
+
+def history_arrays(rows):
+    """Load history rows into arrays of times (epoch seconds), symbols, shares and totals"""
+    columns = [(row["time"].timestamp(), row["symbol"], row["shares"], row["total"])
+               for row in rows if isinstance(row.get("time"), datetime.datetime)]
+    if not columns:
+        return np.empty(0), np.empty(0, dtype=str), np.empty(0), np.empty(0)
+    times, symbols, shares, totals = zip(*columns)
+    return np.array(times, dtype=float), np.array(symbols), np.array(shares, dtype=float), np.array(totals, dtype=float)
+
+
+def _segment_cumsum(values, starts):
+    """Cumulative sum of values that restarts wherever starts is True"""
+    totals = np.cumsum(values)
+    first = np.maximum.accumulate(np.where(starts, np.arange(len(values)), 0))
+    return totals - totals[first] + values[first]
+
+
+def _linear_scan(factors, terms):
+    """Solve x[k] = factors[k] * x[k-1] + terms[k] for every k, with x[-1] = 0
+
+    Runs as log2(n) vectorized doubling steps. Factors lie in [0, 1], so
+    the running products can only shrink and never overflow; a zero factor
+    starts the recurrence afresh.
+    """
+    factors = factors.copy()
+    values = terms.copy()
+    step = 1
+    while step < len(values):
+        values[step:] = values[step:] + factors[step:] * values[:-step]
+        factors[step:] = factors[step:] * factors[:-step]
+        step *= 2
+    return values
+
+
+def _money_weighted_return(times, totals, value, now):
+    """Rate that makes the trades grow into the current value, found by bisection
+
+    Annualized when the history spans more than a year, otherwise for the
+    period itself. None when no rate in range balances the flows.
+    """
+    if not len(times) or value is None:
+        return None
+    years = (now - times) / SECONDS_PER_YEAR
+
+    def surplus(rate):
+        return value - np.sum(totals * (1.0 + rate) ** years)
+
+    low, high = -0.9999, 100.0
+    if surplus(low) * surplus(high) > 0:
+        return None
+    for _ in range(100):
+        mid = (low + high) / 2
+        if surplus(low) * surplus(mid) <= 0:
+            high = mid
+        else:
+            low = mid
+    rate = (low + high) / 2
+    span = years.max()
+    return rate if span >= 1 else (1.0 + rate) ** span - 1.0
+
+
+def performance(rows, quotes, now=None):
+    """Compute P&L, returns and per-symbol contributions for one user's history
+
+    quotes maps currently held symbols to their quotes (with "price" and,
+    if available, a daily "series"). Symbols without a quote are reported
+    with unknown value.
+    """
+    now = now if now is not None else datetime.datetime.now(datetime.timezone.utc).timestamp()
+    times, symbols, shares, totals = history_arrays(rows)
+    result = {"symbols": [], "invested": 0.0, "realized": 0.0, "unrealized": None, "value": None,
+              "total_pnl": None, "twr": None, "mwr": None, "days": [], "contribution_series": {}}
+    if not len(times):
+        return result
+
+    # Group trades by symbol, oldest first within each symbol
+    names, codes = np.unique(symbols, return_inverse=True)
+    order = np.lexsort((times, codes))
+    times, codes, shares, totals = times[order], codes[order], shares[order], totals[order]
+    count = len(times)
+    group_start = np.r_[True, codes[1:] != codes[:-1]]
+    group_first = np.nonzero(group_start)[0]
+    group_last = np.r_[group_first[1:] - 1, count - 1]
+
+    # Shares held after each trade, and the fraction of the position each sale keeps
+    held_after = _segment_cumsum(shares, group_start)
+    held_before = held_after - shares
+    is_sell = shares < 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kept = np.where(held_before > 0, held_after / held_before, 0.0)
+    kept = np.where(is_sell, np.clip(kept, 0.0, 1.0), 1.0)
+
+    # Cost of the position after each trade: cost[k] = kept[k] * cost[k-1] + bought[k],
+    # starting afresh with each symbol and whenever a position is opened from nothing
+    segment_start = group_start | (held_before <= 0)
+    bought = np.where(is_sell, 0.0, totals)
+    cost_after = _linear_scan(np.where(segment_start, 0.0, kept), bought)
+    cost_before = np.where(segment_start, 0.0, np.roll(cost_after, 1))
+
+    # A sale realizes its proceeds (-total) minus the cost of the shares it removed
+    realized = np.where(is_sell, -totals - (1.0 - kept) * cost_before, 0.0)
+    realized_to_date = _segment_cumsum(realized, group_start)
+
+    held = held_after[group_last]
+    cost = cost_after[group_last]
+    realized_by_symbol = realized_to_date[group_last]
+    prices = np.array([quotes[name]["price"] if name in quotes else np.nan for name in names])
+    prices = np.where(held > 0, prices, 0.0)
+    values = held * prices
+    unrealized = values - cost
+    pnl = realized_by_symbol + unrealized
+
+    invested = float(bought.sum())
+    value = float(values.sum())
+    result.update({
+        "invested": invested,
+        "realized": float(realized_by_symbol.sum()),
+        "unrealized": None if np.isnan(value) else float(np.nansum(unrealized)),
+        "value": None if np.isnan(value) else value,
+        "total_pnl": None if np.isnan(value) else float(pnl.sum())
+    })
+    for i, name in enumerate(names):
+        known = not np.isnan(values[i])
+        result["symbols"].append({
+            "symbol": str(name), "shares": int(held[i]), "cost": float(cost[i]),
+            "value": float(values[i]) if known else None,
+            "realized": float(realized_by_symbol[i]),
+            "unrealized": float(unrealized[i]) if known else None,
+            "pnl": float(pnl[i]) if known else None,
+            # Share of everything ever invested that this symbol gained or lost
+            "contribution": float(pnl[i] / invested) if known and invested else None
+        })
+    result["symbols"].sort(key=lambda row: -(row["pnl"] if row["pnl"] is not None else -np.inf))
+
+    # Flows in trade order, for the money-weighted return
+    by_time = np.argsort(times, kind="stable")
+    result["mwr"] = _money_weighted_return(times[by_time], totals[by_time], result["value"], now)
+
+    # Daily figures over the window covered by the cached price series
+    series = [quote["series"] for quote in quotes.values() if quote.get("series") is not None and len(quote["series"])]
+    if not series:
+        return result
+    days = np.asarray(max(series, key=len).timestamps, dtype=float)
+    contribution = np.zeros((len(names), len(days)))
+    day_values = np.zeros(len(days))
+    for i, name in enumerate(names):
+        lo, hi = group_first[i], group_last[i] + 1
+        # Position as of each day: the last trade at or before it
+        at = lo + np.searchsorted(times[lo:hi], days, side="right") - 1
+        before_first = at < lo
+        at = np.maximum(at, lo)
+        day_held = np.where(before_first, 0.0, held_after[at])
+        day_cost = np.where(before_first, 0.0, cost_after[at])
+        day_realized = np.where(before_first, 0.0, realized_to_date[at])
+        quote_series = quotes.get(name, {}).get("series")
+        if quote_series is not None and len(quote_series):
+            close_at = np.searchsorted(quote_series.timestamps, days, side="right") - 1
+            closes = np.where(close_at >= 0, np.asarray(quote_series.closes)[np.maximum(close_at, 0)], np.nan)
+        else:
+            closes = np.where(day_held > 0, np.nan, 0.0)
+        day_value = np.where(day_held > 0, day_held * closes, 0.0)
+        contribution[i] = day_realized + day_value - day_cost
+        day_values += day_value
+
+    result["days"] = [datetime.datetime.fromtimestamp(day, datetime.timezone.utc).strftime("%d %b") for day in days]
+    result["contribution_series"] = {str(name): [None if np.isnan(x) else float(x) for x in contribution[i]]
+                                     for i, name in enumerate(names)}
+
+    # Time-weighted return: chain daily returns with the day's net purchases taken out
+    if not np.isnan(day_values).any():
+        flows = np.cumsum(totals[by_time])
+        flow_to = np.searchsorted(times[by_time], days, side="right") - 1
+        flows_to_date = np.where(flow_to >= 0, flows[np.maximum(flow_to, 0)], 0.0)
+        day_flows = np.diff(flows_to_date)
+        start_values = day_values[:-1]
+        valid = start_values > 0
+        if valid.any():
+            growth = (day_values[1:][valid] - day_flows[valid]) / start_values[valid]
+            result["twr"] = float(np.prod(growth) - 1.0)
+    return result
@@ -1,39 +1,75 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
-from google.api_core import exceptions as google_exceptions
-
-from flask import Flask, flash, redirect, render_template, request, session, url_for
+from flask import (Blueprint, Flask, Response, current_app, flash, g, jsonify, redirect, render_template, request, session,
+                   stream_with_context, url_for)
 from flask_session import Session
 from functools import wraps
-from werkzeug.security import check_password_hash, generate_password_hash
 
+import click
+import csv
 import datetime
-import pytz
-import requests
-import urllib
+import io
+import json
 import os
-from dotenv import load_dotenv
-
-
-# --- Firebase Initialization ---
-try:
-    cred = credentials.Certificate("firebase.json")
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-except Exception as e:
-    print(f"FATAL: Failed to initialize Firebase Admin SDK: {e}")
-    db = None
-# --- End Firebase Initialization ---
-
 
-request_session = requests.Session()
-request_session.headers.update({
-    "Accept": "*/*",
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-})
-
-load_dotenv()
-api_key = os.getenv("API_KEY")
+import analytics
+import lifecycle
+import metrics
+import refresher
+import resting_orders
+from charts import price_chart, sparkline
+from metrics import TimedProxy, span
+from passwords import PasswordHashingBusy, hash_password, needs_rehash, password_hasher, verify_password
+from portfolio import cached_valuation, portfolio_cache, value_portfolio
+from price_stream import PRICE_STREAM_SYMBOLS_MAX, StreamsFull, events, price_hub
+from quotes import TRADE_QUOTE_MAX_AGE, fx_rates, lookup, lookup_many, quote_client, quotes_unavailable
+from resting_orders import order_book, order_evaluator
+from storage import DATABASE_ERRORS, LazyStorage, UnitOfWork, create_storage
+from symbols import symbol_index
+
+
+# --- Storage Initialization ---
+# Created on first use in each worker process; every storage call is timed as the "db" span of the request
+db = LazyStorage(lambda: TimedProxy(create_storage(), "db"))
+# --- End Storage Initialization ---
+
+# Number of transactions shown per page of history
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+# Most legs accepted in one batch order (each leg is a few writes of one transaction)
+ORDER_MAX_LEGS = int(os.getenv("ORDER_MAX_LEGS", "50"))
+
+
+def unit_of_work():
+    """Return the request's unit of work, which reads each user document at most once"""
+    if "unit_of_work" not in g:
+        g.unit_of_work = UnitOfWork(db)
+    return g.unit_of_work
+
+
+def portfolio_changed():
+    """Drop the user's cached valuation after a transaction, in this and (via the session) every worker"""
+    portfolio_cache.invalidate(session["user_id"])
+    session["portfolio_version"] = session.get("portfolio_version", 0) + 1
+
+
+def portfolio_version(orders=None):
+    """Return the version of the user's positions, moving it on if one of their resting orders was closed meanwhile
+
+    Resting orders are filled by whichever worker evaluates them, so the
+    session keeps the IDs of the user's open orders; while there are any,
+    they are read again (one query, unless the caller already has them)
+    to notice fills made in another worker.
+    """
+    open_orders = session.get("open_orders", [])
+    if orders is None and open_orders:
+        orders = db.get_orders(session["user_id"])
+    if orders is not None:
+        current = sorted(order["id"] for order in orders)
+        if current != open_orders:
+            session["open_orders"] = current
+            portfolio_changed()
+            # The balances kept in the session may predate a fill too
+            for key in ("sum", "balance", "deposit", "withdraw"):
+                session.pop(key, None)
+    return session.get("portfolio_version", 0)
 
 
 def apology(message, code=400):
@@ -44,33 +80,34 @@ def apology(message, code=400):
     if not username_for_template and "user_id" in session: # Attempt to get username if only ID exists
         try:
             if db:
-                user_doc = db.collection("users").document(session["user_id"]).get()
-                if user_doc.exists:
-                    username_for_template = user_doc.to_dict().get("username", "")
+                user_data = unit_of_work().get_user(session["user_id"])
+                if user_data:
+                    username_for_template = user_data.get("username", "")
         except Exception:
             pass # Ignore if db access fails here
 
     # Try to render the current endpoint's template, or redirect to index on failure/no endpoint
     # This logic attempts to re-render the page where the error occurred.
     # It's a simplified approach; complex pages might need more specific context.
-    if request.endpoint and request.endpoint != "static":
-        template_name = request.endpoint + ".html"
+    endpoint = request.endpoint.rpartition(".")[2] if request.endpoint else None
+    if endpoint and endpoint != "static":
+        template_name = endpoint + ".html"
         try:
             extra_context = {}
             # Provide minimal context for common pages if an error occurs on them during GET
             if request.method == "GET":
-                if request.endpoint == "index":
+                if endpoint == "index":
                     extra_context = { "rows": [], "balance": session.get("balance",0), "deposit": session.get("deposit",0), "withdraw": session.get("withdraw",0), "sum": session.get("sum",0) }
-                elif request.endpoint == "sell": # For sell GET page
+                elif endpoint == "sell": # For sell GET page
                     extra_context = {"rows": []}
-                elif request.endpoint == "history":
+                elif endpoint == "history":
                      extra_context = {"rows": [], "sum":session.get("sum",0), "balance":session.get("balance",0), "deposit":session.get("deposit",0), "withdraw":session.get("withdraw",0)}
                 # Add other specific GET contexts if needed for re-rendering on error
             return render_template(template_name, username=username_for_template, **extra_context)
         except Exception:
             # Fallback if template rendering fails or template doesn't exist for the endpoint
-            return redirect(url_for("index"))
-    return redirect(url_for("index")) # Default fallback
+            return redirect(url_for("webquity.index"))
+    return redirect(url_for("webquity.index")) # Default fallback
 
 
 def login_required(f):
@@ -90,58 +127,16 @@ def login_required(f):
     return decorated_function
 
 
-def lookup(symbol):
-    """Look up quote for symbol"""
-
-    # Prepare API request
-    symbol = symbol.upper()
-    end = datetime.datetime.now(pytz.timezone("US/Eastern"))
-    start = end - datetime.timedelta(days=7)
-
-    # Yahoo Finance API
-    url = (
-        f"https://query2.finance.yahoo.com/v8/finance/chart/{urllib.parse.quote_plus(symbol)}"
-        f"?period1={int(start.timestamp())}"
-        f"&period2={int(end.timestamp())}"
-        f"&interval=1d&events=history&includeAdjustedClose=true"
-    )
-
-    # Query API
-    try:
-        response = request_session.get(url)
-        response.raise_for_status()
-
-        data = response.json()
-        result = data["chart"]["result"][0]["meta"]["regularMarketPrice"]
-
-        exchange_rate = request_session.get(
-            f"https://v6.exchangerate-api.com/v6/{api_key}/pair/USD/INR").json()["conversion_rate"]
-        price = exchange_rate * result
-        return {"price": price, "symbol": symbol}
-    except (KeyError, IndexError, requests.RequestException, ValueError):
-        return None
-
-
 def inr(value):
     """Format value as INR"""
     return f"₹{value:,.2f}"
 
 
-# Configure application
-app = Flask(__name__)
-
-# Custom filter
-app.jinja_env.filters["inr"] = inr
-
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+# Routes, registered on the app by create_app (CLI commands stay top-level: flask backfill-positions)
+bp = Blueprint("webquity", __name__, cli_group=None)
 
-# Configure CS50 Library to use SQLite database # This line is removed as db is now Firestore
 
-
-@app.after_request
+@bp.after_app_request
 def after_request(response):
     """Ensure responses aren't cached"""
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
@@ -150,93 +145,89 @@ def after_request(response):
     return response
 
 
-@app.route("/")
+@bp.route("/")
 @login_required
 def index():
     """Show portfolio of stocks"""
     if not db: return apology("currently unable to access database", 503)
     try:
-        user_doc_ref = db.collection("users").document(session["user_id"])
-        user_snapshot = user_doc_ref.get()
-
-        if not user_snapshot.exists:
-            session.clear() # User data missing, clear session and force login
-            return apology("User data not found. Please log in again.", 404)
-        usrdata = user_snapshot.to_dict()
-
-        # Fetch all required data (from history subcollection)
-        history_ref = user_doc_ref.collection("history")
-        history_docs_query = history_ref.stream()
-
-        aggregated_portfolio = {}
-        for doc in history_docs_query:
-            item = doc.to_dict()
-            symbol = item["symbol"]
-            if symbol not in aggregated_portfolio:
-                # Initialize structure for each symbol
-                aggregated_portfolio[symbol] = {"shares": 0, "total_cost_basis": 0, "symbol": symbol}
-            aggregated_portfolio[symbol]["shares"] += item.get("shares", 0)
-            # 'total' in history is price * shares at time of transaction
-            # For buys, total is positive cost. For sells, total is negative proceeds.
-            # Summing them up gives the net cost basis for currently held shares.
-            aggregated_portfolio[symbol]["total_cost_basis"] += item.get("total", 0)
-
-
-        # Initialize variables
-        param = []
-        current_grand_total_value = 0.0
-        session["balance"] = float(usrdata.get("cash", 0.0))
-        session["deposit"] = float(usrdata.get("deposit", 0.0))
-        session["withdraw"] = float(usrdata.get("withdraw", 0.0))
-
-        for symbol, data in aggregated_portfolio.items():
-            if data["shares"] > 0: # Only process stocks currently owned
-                quote = lookup(symbol)
-                if quote:
-                    current_price = quote["price"]
-                    current_value_of_holding = current_price * data["shares"]
-                    # Average cost price for the shares currently held
-                    avg_cost_price = (data["total_cost_basis"] / data["shares"]) if data["shares"] != 0 else 0
-
-                    param.append({
-                        "symbol": symbol,
-                        "shares": data["shares"],
-                        "price": current_price,
-                        "oldprice": avg_cost_price,
-                        "total": current_value_of_holding
-                    })
-                    current_grand_total_value += current_value_of_holding
-                else:
-                    # Handle case where lookup fails for an owned stock
-                    avg_cost_price_fallback = (data["total_cost_basis"] / data["shares"]) if data["shares"] != 0 else "N/A"
-                    param.append({
-                        "symbol": symbol, "shares": data["shares"], "price": "N/A",
-                        "oldprice": avg_cost_price_fallback,
-                        "total": "N/A"
-                    })
-
-        session["sum"] = current_grand_total_value
-
-        return render_template("index.html", rows=param, balance=session["balance"], username=session["username"],
+        # Repeat visits are served from the cached valuation, which is repriced as quotes come in
+        version = portfolio_version()
+        valuation = cached_valuation(session["user_id"], version)
+        if valuation is None:
+            usrdata = unit_of_work().get_user(session["user_id"])
+
+            if not usrdata:
+                session.clear() # User data missing, clear session and force login
+                return apology("User data not found. Please log in again.", 404)
+
+            # Holdings come from the positions maintained by buy/sell
+            valuation = value_portfolio(usrdata, db.get_positions(session["user_id"]))
+            portfolio_cache.put(session["user_id"], version, valuation)
+
+        session["balance"] = valuation.balance
+        session["deposit"] = valuation.deposit
+        session["withdraw"] = valuation.withdraw
+        session["sum"] = valuation.total
+
+        return render_template("index.html", rows=valuation.rows, balance=session["balance"], username=session["username"],
                                deposit=session["deposit"], withdraw=session["withdraw"], sum=session["sum"])
     except Exception:
         return apology("currently unable to access database", 503)
 
 
-@app.route("/history")
+@bp.route("/prices/stream")
+@login_required
+def price_stream():
+    """Stream live prices of the user's holdings (and any extra ?symbols=A,B) as Server-Sent Events"""
+    symbols = [symbol for symbol in request.args.get("symbols", "").upper().split(",") if symbol.isalnum()]
+    valuation = portfolio_cache.get(session["user_id"], session.get("portfolio_version", 0))
+    if valuation is not None:
+        symbols += valuation.symbols()
+    elif db:
+        try:
+            symbols += [position["symbol"] for position in db.get_positions(session["user_id"])]
+        except DATABASE_ERRORS as e:
+            current_app.logger.warning(f"Could not read holdings for price stream: {e!r}")
+    symbols = list(dict.fromkeys(symbols))[:PRICE_STREAM_SYMBOLS_MAX]
+
+    try:
+        subscription = price_hub.subscribe(symbols)
+    except StreamsFull:
+        # EventSource retries after the delay the stream asked for, or a few seconds by default
+        return Response("Too many price streams\n", status=503, mimetype="text/plain", headers={"Retry-After": "30"})
+    response = Response(stream_with_context(events(subscription)), mimetype="text/event-stream",
+                        headers={"X-Accel-Buffering": "no"}) # Tell proxies not to buffer the stream
+    # Also covers a client that leaves before the stream starts
+    response.call_on_close(lambda: price_hub.unsubscribe(subscription))
+    return response
+
+
+@bp.route("/history")
 @login_required
 def history():
     """Show history of transactions"""
     if not db: return apology("currently unable to access database", 503)
     try:
-        user_doc_ref = db.collection("users").document(session["user_id"])
-        # Order by time, descending to show newest first
-        history_query = user_doc_ref.collection("history").order_by("time", direction=firestore.Query.DESCENDING)
-        history_docs = history_query.stream()
+        # Optional filters
+        symbol_filter = request.args.get("symbol", "").upper()
+        type_filter = request.args.get("type", "")
+        if symbol_filter and not symbol_filter.isalnum():
+            return apology("invalid symbol", 400)
+        if type_filter and type_filter not in ("buy", "sell"):
+            return apology("invalid transaction type", 400)
+
+        # Pages are addressed by the ID of the last (after) or first (before) row of the
+        # neighbouring page, so every page costs a fixed number of reads
+        try:
+            history_rows, has_prev, has_next = db.history_page(
+                session["user_id"], HISTORY_PAGE_SIZE, after=request.args.get("after"),
+                before=request.args.get("before"), symbol=symbol_filter, type=type_filter)
+        except ValueError:
+            return apology("invalid page", 400)
 
         rows = []
-        for doc in history_docs:
-            data = doc.to_dict()
+        for data in history_rows:
             # Format timestamp for display
             time_val = data.get("time")
             if isinstance(time_val, datetime.datetime):
@@ -249,21 +240,110 @@ def history():
                 data["time_formatted"] = str(time_val if time_val else "N/A")
             rows.append(data)
 
-        # Retrieve history and create the view with user-specific data
-        # Also fetch current user data for balance display consistency in template
-        user_snapshot = user_doc_ref.get()
-        usrdata = user_snapshot.to_dict() if user_snapshot.exists else {}
+        # Links to the neighbouring pages keep the active filters
+        filters = {key: value for key, value in (("symbol", symbol_filter), ("type", type_filter)) if value}
+        prev_url = url_for(".history", before=rows[0]["id"], **filters) if has_prev and rows else None
+        next_url = url_for(".history", after=rows[-1]["id"], **filters) if has_next and rows else None
+
+        # The balances shown come from the cached valuation, or else the session (kept up to
+        # date by every transaction); the user is only read if one of them is missing
+        valuation = portfolio_cache.get(session["user_id"], portfolio_version())
+        if valuation is not None:
+            figures = {"sum": valuation.total, "balance": valuation.balance, "deposit": valuation.deposit,
+                       "withdraw": valuation.withdraw}
+        else:
+            if all(key in session for key in ("sum", "balance", "deposit", "withdraw")):
+                usrdata = {}
+            else:
+                usrdata = unit_of_work().get_user(session["user_id"]) or {}
+            figures = {"sum": session.get("sum", usrdata.get("sum",0.0)), # Use session or fresh from usrdata
+                       "balance": session.get("balance", usrdata.get("cash",0.0)),
+                       "deposit": session.get("deposit", usrdata.get("deposit",0.0)),
+                       "withdraw": session.get("withdraw", usrdata.get("withdraw",0.0))}
 
         return render_template("history.html", rows=rows, username=session["username"],
-                               sum=session.get("sum", usrdata.get("sum",0.0)), # Use session or fresh from usrdata
-                               balance=session.get("balance", usrdata.get("cash",0.0)),
-                               deposit=session.get("deposit", usrdata.get("deposit",0.0)),
-                               withdraw=session.get("withdraw", usrdata.get("withdraw",0.0)))
+                               symbol=symbol_filter, type=type_filter, prev_url=prev_url, next_url=next_url, **figures)
     except Exception:
         return apology("currently unable to access database", 503)
 
 
-@app.route("/register", methods=["GET", "POST"])
+EXPORT_FIELDS = ["time", "type", "symbol", "shares", "price", "total"]
+
+
+def export_row(row):
+    """History row as plain values for export, with the time in ISO 8601"""
+    values = {field: row.get(field) for field in EXPORT_FIELDS}
+    if isinstance(values["time"], datetime.datetime):
+        values["time"] = values["time"].isoformat()
+    return values
+
+
+def export_csv(rows):
+    """Yield history rows as CSV text, the header first and then one line per row"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(export_row(row))
+        # Hand over each line as soon as it is written, so memory stays flat
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_ndjson(rows):
+    """Yield history rows as newline-delimited JSON, one object per line"""
+    for row in rows:
+        yield json.dumps(export_row(row)) + "\n"
+
+
+@bp.route("/history/export")
+@login_required
+def export_history():
+    """Download the whole history (or a date range of it) as CSV or NDJSON, oldest first"""
+    if not db: return apology("currently unable to access database", 503)
+    export_format = request.args.get("format", "csv")
+    if export_format not in ("csv", "ndjson"):
+        return apology("invalid export format", 400)
+    try:
+        # Dates are inclusive and in UTC
+        start = request.args.get("start")
+        end = request.args.get("end")
+        start = datetime.datetime.strptime(start, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc) if start else None
+        end = (datetime.datetime.strptime(end, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+               + datetime.timedelta(days=1)) if end else None
+    except ValueError:
+        return apology("invalid date", 400)
+
+    # Rows are read a page at a time while the response is being sent
+    rows = db.iter_history(session["user_id"], start=start, end=end)
+    if export_format == "csv":
+        body, mimetype = export_csv(rows), "text/csv"
+    else:
+        body, mimetype = export_ndjson(rows), "application/x-ndjson"
+    filename = f"webquity-history.{export_format}"
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
+@bp.route("/performance")
+@login_required
+def performance():
+    """Show realized and unrealized P&L, returns and per-symbol contributions"""
+    if not db: return apology("currently unable to access database", 503)
+    try:
+        positions = db.get_positions(session["user_id"])
+        quotes = lookup_many(position["symbol"] for position in positions)
+        with span("analytics"):
+            report = analytics.performance(db.iter_history(session["user_id"]), quotes)
+        return render_template("performance.html", report=report, username=session["username"])
+    except DATABASE_ERRORS as e:
+        current_app.logger.error(f"Database error in performance route: {e}")
+        return apology("currently unable to access database", 503)
+
+
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     """Register user"""
     if not db: return apology("currently unable to access database", 503)
@@ -309,30 +389,22 @@ def register():
             return apology("password must contain 8-16 characters", 400)
 
         try:
-            users_ref = db.collection("users")
-            # Ensure username does not already exist
-            query = users_ref.where(filter=firestore.FieldFilter("username", "==", username)).limit(1).stream()
-            if len(list(query)) > 0:
-                return apology("username already exists", 400)
-
-            # Insert new user into database
-            new_user_data = {
-                "username": username,
-                "hash": generate_password_hash(password),
-                "cash": 0.0,
-                "deposit": 0.0,
-                "withdraw": 0.0,
-                "created_at": firestore.SERVER_TIMESTAMP
-            }
-            update_time, doc_ref = users_ref.add(new_user_data)
+            # Insert new user into database (fails if the username already exists)
+            user_id = db.create_user(username, hash_password(password))
 
             # Remember which user has logged in
-            session["user_id"] = doc_ref.id
+            session["user_id"] = user_id
             session["username"] = username
             flash("Welcome " + username + "!")
 
             # Redirect user to home page
             return redirect("/")
+        except ValueError as ve:
+            if str(ve) == "Username already exists":
+                return apology("username already exists", 400)
+            return apology("An error occurred during registration.", 400)
+        except PasswordHashingBusy:
+            return apology("too many requests, please try again shortly", 503)
         except Exception:
             return apology("currently unable to access database", 503)
 
@@ -341,7 +413,7 @@ def register():
         return render_template("register.html", username=session.get("username", ""))
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
     if not db: return apology("currently unable to access database", 503)
@@ -361,18 +433,23 @@ def login():
 
         try:
             # Query database for username
-            users_ref = db.collection("users")
-            query = users_ref.where(filter=firestore.FieldFilter("username", "==", username)).limit(1).stream()
-            user_docs = list(query)
+            user_data = unit_of_work().get_user_by_username(username)
 
             # Ensure username exists and password is correct
-            if len(user_docs) != 1 or not check_password_hash(
-                user_docs[0].to_dict().get("hash",""), password
+            if user_data is None or not verify_password(
+                user_data.get("hash",""), password
             ):
                 return apology("invalid username and/or password", 403)
 
-            user_data = user_docs[0].to_dict()
-            user_id = user_docs[0].id
+            user_id = user_data["id"]
+
+            # Upgrade hashes made with older parameters while the password is at hand
+            if needs_rehash(user_data.get("hash", "")):
+                try:
+                    db.update_password_hash(user_id, hash_password(password))
+                    unit_of_work().forget(user_id)
+                except (PasswordHashingBusy, *DATABASE_ERRORS) as e:
+                    current_app.logger.warning(f"Could not rehash password on login: {e!r}")
 
             # Remember which user has logged in
             session["user_id"] = user_id
@@ -382,10 +459,19 @@ def login():
             session["deposit"] = float(user_data.get("deposit", 0.0))
             session["withdraw"] = float(user_data.get("withdraw", 0.0))
             # session["sum"] will be calculated by index route
+            # Open resting orders, whose fills (possibly by another worker) are checked for by portfolio_version;
+            # best effort, as the login itself has succeeded
+            try:
+                session["open_orders"] = sorted(order["id"] for order in db.get_orders(user_id))
+            except DATABASE_ERRORS as e:
+                current_app.logger.warning(f"Could not read open orders on login: {e!r}")
+                session["open_orders"] = []
 
             flash("Welcome " + user_data["username"] + "!")
             # Redirect user to home page
             return redirect("/")
+        except PasswordHashingBusy:
+            return apology("too many requests, please try again shortly", 503)
         except Exception:
             return apology("currently unable to access database", 503)
 
@@ -394,7 +480,7 @@ def login():
         return render_template("login.html", username=session.get("username", ""))
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     """Log user out"""
 
@@ -405,7 +491,14 @@ def logout():
     return redirect("/")
 
 
-@app.route("/search", methods=["GET", "POST"])
+@bp.route("/symbols")
+@login_required
+def symbols():
+    """Suggest symbols starting with the query, from the local symbol index"""
+    return jsonify(symbol_index.search(request.args.get("q", "")))
+
+
+@bp.route("/search", methods=["GET", "POST"])
 @login_required
 def search():
     """Search up stock information."""
@@ -416,11 +509,9 @@ def search():
         if str(symbol_input).isalnum():
             quote = lookup(symbol_input)
 
-            # Get charts for the symbol
+            # The chart is drawn from the daily closes that came with the quote
             if quote:
-                url1 = f"https://api.wsj.net/api/kaavio/charts/big.chart?nosettings=1&symb={quote['symbol']}&uf=0&type=2&size=2&style=320&freq=1&time=7&compidx=&ma=0&maval=9&lf=1&lf2=0&lf3=0&height=335&width=579&mocktick=1"
-                url2 = f"https://api.wsj.net/api/kaavio/charts/big.chart?nosettings=1&symb={quote['symbol']}&uf=0&type=2&size=2&style=320&freq=2&time=12&compidx=&ma=0&maval=9&lf=1&lf2=0&lf3=0&height=335&width=579&mocktick=1"
-                return render_template("search.html", quote=quote, username=session["username"], url1=url1, url2=url2)
+                return render_template("search.html", quote=quote, username=session["username"])
             else:
                 return apology("invalid symbol or data not found", 400)
         else:
@@ -430,7 +521,7 @@ def search():
         return render_template("search.html", quote="", username=session["username"])
 
 
-@app.route("/buy", methods=["GET", "POST"])
+@bp.route("/buy", methods=["GET", "POST"])
 @login_required
 def buy():
     """Buy shares of stock"""
@@ -441,7 +532,8 @@ def buy():
 
         # Check for invalid entries
         if str(symbol_input).isalnum():
-            quote = lookup(symbol_input)
+            # Never trade on a stale price
+            quote = lookup(symbol_input, max_age=TRADE_QUOTE_MAX_AGE, allow_stale=False)
         else:
             return apology("invalid symbol", 400)
         try:
@@ -449,76 +541,42 @@ def buy():
         except (ValueError, TypeError):
             return apology("invalid entry for shares", 400)
 
-        if not quote:
+        if not quote and quotes_unavailable():
+            return apology("stock prices are currently unavailable, please try again later", 503)
+        elif not quote:
             return apology("invalid symbol or stock data not found", 400)
         elif shares <= 0: # Check if shares is positive
             return apology("shares must be a positive number", 400)
 
-        cost = quote["price"] * shares
-
         try:
-            user_ref = db.collection("users").document(session["user_id"])
-
-            # Check balance (Optimistic check before transaction)
-            current_user_snapshot_for_balance_check = user_ref.get()
-            if not current_user_snapshot_for_balance_check.exists:
-                return apology("User data error", 500)
-            current_balance_from_db = float(current_user_snapshot_for_balance_check.to_dict().get("cash", 0.0))
-            if cost > current_balance_from_db:
-                return apology("insufficient balance", 400)
-
-            @firestore.transactional
-            def buy_transaction(transaction, user_doc_ref, purchase_cost, quote_data, num_shares):
-                snapshot = user_doc_ref.get(transaction=transaction)
-                if not snapshot.exists: raise Exception("User not found during transaction")
-
-                user_data = snapshot.to_dict()
-                if user_data is None:
-                    raise Exception("User data is unexpectedly None in transaction")
-                current_cash = float(user_data.get("cash", 0.0))
-                if current_cash < purchase_cost:
-
-                    raise ValueError("Insufficient balance")
-
-                new_cash = current_cash - purchase_cost
-                transaction.update(user_doc_ref, {"cash": new_cash})
-
-                history_doc_ref = user_doc_ref.collection("history").document() # Auto-ID
-                transaction_data = {
-                    "symbol": quote_data["symbol"], "price": quote_data["price"],
-                    "shares": num_shares, "time": firestore.SERVER_TIMESTAMP,
-                    "total": purchase_cost, "type": "buy"
-                }
-                transaction.set(history_doc_ref, transaction_data)
-                return new_cash
-
-            # Execute the transaction
-            new_balance_after_buy = buy_transaction(db.transaction(), user_ref, cost, quote, shares)
+            # Execute the transaction, which checks the balance and reads it before and after
+            change = unit_of_work().buy(session["user_id"], quote["symbol"], quote["price"], shares)
 
             # Update session
-            session["balance"] = new_balance_after_buy
+            session["balance"] = float(change.after["cash"])
+            portfolio_changed()
 
             flash("Bought Stocks Successfully")
             row_display = {"symbol": quote["symbol"], "price": quote["price"], "shares": shares}
             # Pass the balance *before* transaction for display, and new balance for currbalance
-            return render_template("transaction.html", row=row_display, balance=current_balance_from_db,
+            return render_template("transaction.html", row=row_display, balance=float(change.before["cash"]),
                                    currbalance=session["balance"], username=session["username"])
 
         except ValueError as ve: # Specifically for "Insufficient balance" from transaction
             if str(ve) == "Insufficient balance":
                 return apology("insufficient balance", 400)
             return apology("An error occurred during purchase.", 400) # Other ValueErrors
-        except google_exceptions.GoogleAPICallError as e:
-            app.logger.error(f"Firebase API error in buy route: {e}")
+        except DATABASE_ERRORS as e:
+            current_app.logger.error(f"Database error in buy route: {e}")
             return apology("currently unable to access database", 503)
         except Exception as e:
-            app.logger.error(f"Unexpected error in buy route: {e}")
+            current_app.logger.error(f"Unexpected error in buy route: {e}")
             return apology("An unexpected error occurred during purchase.", 500)
     else:
         return render_template("buy.html", username=session["username"])
 
 
-@app.route("/sell", methods=["GET", "POST"])
+@bp.route("/sell", methods=["GET", "POST"])
 @login_required
 def sell():
     """Sell shares of stock"""
@@ -531,7 +589,8 @@ def sell():
         if not symbol_to_sell:
             return apology("missing symbol", 400)
         if str(symbol_to_sell).isalnum():
-            quote = lookup(symbol_to_sell)
+            # Never trade on a stale price
+            quote = lookup(symbol_to_sell, max_age=TRADE_QUOTE_MAX_AGE, allow_stale=False)
         else:
             return apology("invalid symbol", 400)
         try:
@@ -539,93 +598,187 @@ def sell():
         except (ValueError, TypeError):
             return apology("invalid entry for shares", 400)
 
+        if not quote and quotes_unavailable():
+            return apology("stock prices are currently unavailable, please try again later", 503)
         if not quote:
             return apology("invalid symbol or stock data not found", 400)
         if shares_to_sell <= 0:
             return apology("shares must be a positive number", 400)
 
-        proceeds = quote["price"] * shares_to_sell
-
         try:
-            user_ref = db.collection("users").document(session["user_id"])
-
-            @firestore.transactional
-            def sell_transaction(transaction, user_doc_ref, symbol, num_shares_to_sell, sale_proceeds, current_quote_price):
-                # Check current holdings within the transaction
-                history_snapshot_query = user_doc_ref.collection("history").where(filter=firestore.FieldFilter("symbol", "==", symbol))
-                history_docs_for_symbol = history_snapshot_query.stream(transaction=transaction)
-
-                current_shares_owned = sum(doc.to_dict().get("shares", 0) for doc in history_docs_for_symbol)
-
-                if current_shares_owned < num_shares_to_sell:
-                    raise ValueError("Insufficient shares")
-
-                user_snapshot = user_doc_ref.get(transaction=transaction)
-                if not user_snapshot.exists: raise Exception("User not found during transaction")
-
-                user_data = user_snapshot.to_dict()
-                if user_data is None:
-                    raise Exception("User data is unexpectedly None in transaction")
-                new_cash = float(user_data.get("cash", 0.0)) + sale_proceeds
-                transaction.update(user_doc_ref, {"cash": new_cash})
-
-                history_doc_ref = user_doc_ref.collection("history").document() # Auto-ID
-                transaction_data = {
-                    "symbol": symbol, "price": current_quote_price,
-                    "shares": -num_shares_to_sell, # Negative for sell
-                    "time": firestore.SERVER_TIMESTAMP,
-                    "total": -sale_proceeds, # Negative total for sell
-                    "type": "sell"
-                }
-                transaction.set(history_doc_ref, transaction_data)
-                return new_cash
-
-            # Get balance before transaction for display
-            current_user_snapshot_for_balance_check = user_ref.get()
-            if not current_user_snapshot_for_balance_check.exists:
-                return apology("User data error", 500)
-            balance_before_sell = float(current_user_snapshot_for_balance_check.to_dict().get("cash", 0.0))
-
-            # Execute transaction
-            new_balance_after_sell = sell_transaction(db.transaction(), user_ref, symbol_to_sell, shares_to_sell, proceeds, quote["price"])
+            # Execute transaction, which also reads the balances before and after it
+            change = unit_of_work().sell(session["user_id"], symbol_to_sell, quote["price"], shares_to_sell)
 
             # Update session
-            session["balance"] = new_balance_after_sell
+            session["balance"] = float(change.after["cash"])
+            portfolio_changed()
 
             flash("Sold Stocks Successfully")
             row_display = {"symbol": symbol_to_sell, "price": quote["price"], "shares": shares_to_sell}
-            return render_template("transaction.html", row=row_display, balance=balance_before_sell,
+            return render_template("transaction.html", row=row_display, balance=float(change.before["cash"]),
                                    currbalance=session["balance"], username=session["username"])
 
         except ValueError as ve: # Specifically for "Insufficient shares"
             if str(ve) == "Insufficient shares":
                 return apology("insufficient shares", 400)
             return apology("An error occurred during sale.", 400) # Other ValueErrors
-        except google_exceptions.GoogleAPICallError as e:
-            app.logger.error(f"Firebase API error in sell route: {e}")
+        except DATABASE_ERRORS as e:
+            current_app.logger.error(f"Database error in sell route: {e}")
             return apology("currently unable to access database", 503)
         except Exception as e:
-            app.logger.error(f"Unexpected error in sell route: {e}")
+            current_app.logger.error(f"Unexpected error in sell route: {e}")
             return apology("An unexpected error occurred during sale.", 500)
     else: # GET request
         try:
-            user_doc_ref = db.collection("users").document(session["user_id"])
-            history_docs = user_doc_ref.collection("history").stream()
-
-            owned_symbols_agg = {}
-            for doc in history_docs:
-                item = doc.to_dict()
-                symbol = item["symbol"]
-                owned_symbols_agg[symbol] = owned_symbols_agg.get(symbol, 0) + item.get("shares",0)
-
             # Provide symbols that user actually owns (shares > 0)
-            symbols_for_template = [{"symbol": sym} for sym, count in owned_symbols_agg.items() if count > 0]
+            symbols_for_template = [{"symbol": position["symbol"]} for position in db.get_positions(session["user_id"])]
             return render_template("sell.html", rows=symbols_for_template, username=session["username"])
         except Exception:
             return apology("currently unable to access database", 503)
 
 
-@app.route("/deposit", methods=["GET", "POST"])
+def order_error(message, code=400):
+    """Reject a batch order with a JSON error"""
+    return jsonify({"error": message}), code
+
+
+@bp.route("/orders", methods=["POST"])
+@login_required
+def orders():
+    """Buy and sell several stocks at once, all or nothing
+
+    Takes {"orders": [{"symbol": "AAPL", "side": "buy", "shares": 3}, ...]}.
+    Every leg is priced from one batch of quotes, and the whole order is
+    checked and recorded in one transaction.
+    """
+    if not db: return order_error("currently unable to access database", 503)
+    legs = (request.get_json(silent=True) or {}).get("orders")
+    if not isinstance(legs, list) or not legs:
+        return order_error("missing orders")
+    if len(legs) > ORDER_MAX_LEGS:
+        return order_error(f"at most {ORDER_MAX_LEGS} orders at once")
+
+    # Validate every leg before pricing any of them
+    parsed = []
+    for leg in legs:
+        if not isinstance(leg, dict):
+            return order_error("invalid order")
+        symbol = str(leg.get("symbol", "")).upper()
+        side = leg.get("side")
+        shares = leg.get("shares")
+        if not symbol.isalnum():
+            return order_error(f"invalid symbol: {symbol}")
+        if side not in ("buy", "sell"):
+            return order_error(f"invalid side for {symbol}")
+        # Shares must be whole, positive numbers
+        if not isinstance(shares, int) or isinstance(shares, bool) or shares <= 0:
+            return order_error(f"invalid entry for shares of {symbol}")
+        parsed.append((symbol, side, shares))
+
+    # Never trade on a stale price
+    quotes = lookup_many((symbol for symbol, side, shares in parsed), max_age=TRADE_QUOTE_MAX_AGE, allow_stale=False)
+    unpriced = [symbol for symbol, side, shares in parsed if symbol not in quotes]
+    if unpriced and quotes_unavailable():
+        return order_error("stock prices are currently unavailable, please try again later", 503)
+    if unpriced:
+        return order_error(f"invalid symbol or stock data not found: {', '.join(dict.fromkeys(unpriced))}")
+
+    trade_legs = [(symbol, quotes[symbol]["price"], shares if side == "buy" else -shares)
+                  for symbol, side, shares in parsed]
+    try:
+        change = unit_of_work().trade(session["user_id"], trade_legs)
+    except ValueError as ve:
+        if str(ve) in ("Insufficient balance", "Insufficient shares"):
+            return order_error(str(ve).lower())
+        return order_error("An error occurred during the order.")
+    except DATABASE_ERRORS as e:
+        current_app.logger.error(f"Database error in orders route: {e}")
+        return order_error("currently unable to access database", 503)
+    except Exception as e:
+        current_app.logger.error(f"Unexpected error in orders route: {e}")
+        return order_error("An unexpected error occurred during the order.", 500)
+
+    session["balance"] = float(change.after["cash"])
+    portfolio_changed()
+    return jsonify({
+        "orders": [{"symbol": symbol, "side": side, "shares": shares, "price": quotes[symbol]["price"],
+                    "total": quotes[symbol]["price"] * shares} for symbol, side, shares in parsed],
+        "balance_before": float(change.before["cash"]),
+        "balance": session["balance"]
+    })
+
+
+@bp.route("/pending-orders", methods=["GET", "POST"])
+@login_required
+def pending_orders():
+    """Place limit and stop orders, and list the open ones"""
+    if not db: return apology("currently unable to access database", 503)
+    if request.method == "POST":
+        symbol_input = request.form.get("symbol", "").upper()
+        side = request.form.get("side")
+        order_type = request.form.get("type")
+
+        # Check for invalid entries
+        if not symbol_input.isalnum():
+            return apology("invalid symbol", 400)
+        if side not in ("buy", "sell"):
+            return apology("invalid side", 400)
+        if order_type not in ("limit", "stop"):
+            return apology("invalid order type", 400)
+        try:
+            shares = int(request.form.get("shares")) # Shares must be whole numbers
+            trigger_price = float(request.form.get("price"))
+        except (ValueError, TypeError):
+            return apology("invalid entry for shares or price", 400)
+        if shares <= 0:
+            return apology("shares must be a positive number", 400)
+        if not trigger_price > 0:
+            return apology("price must be a positive number", 400)
+
+        # Only accept symbols that can be priced
+        quote = lookup(symbol_input)
+        if not quote and quotes_unavailable():
+            return apology("stock prices are currently unavailable, please try again later", 503)
+        elif not quote:
+            return apology("invalid symbol or stock data not found", 400)
+
+        try:
+            order = db.place_order(session["user_id"], quote["symbol"], side, order_type, shares, trigger_price)
+        except DATABASE_ERRORS as e:
+            current_app.logger.error(f"Database error in pending orders route: {e}")
+            return apology("currently unable to access database", 503)
+        order_book.add(order)
+        session["open_orders"] = sorted(session.get("open_orders", []) + [order["id"]])
+        flash("Order Placed Successfully")
+        return redirect(url_for(".pending_orders"))
+
+    try:
+        rows = db.get_orders(session["user_id"])
+        portfolio_version(rows) # Catches orders filled by other workers since the last visit
+    except DATABASE_ERRORS:
+        return apology("currently unable to access database", 503)
+    return render_template("pending_orders.html", rows=rows, username=session["username"])
+
+
+@bp.route("/pending-orders/<order_id>/cancel", methods=["POST"])
+@login_required
+def cancel_pending_order(order_id):
+    """Cancel an open limit or stop order"""
+    if not db: return apology("currently unable to access database", 503)
+    try:
+        db.cancel_order(session["user_id"], order_id)
+    except ValueError:
+        flash("Order Not Found Or Already Closed")
+        return redirect(url_for(".pending_orders"))
+    except DATABASE_ERRORS:
+        return apology("currently unable to access database", 503)
+    order_book.remove(order_id)
+    session["open_orders"] = [open_id for open_id in session.get("open_orders", []) if open_id != order_id]
+    flash("Order Cancelled Successfully")
+    return redirect(url_for(".pending_orders"))
+
+
+@bp.route("/deposit", methods=["GET", "POST"])
 @login_required
 def deposit():
     """Add cash to account"""
@@ -642,38 +795,17 @@ def deposit():
             return apology("invalid amount", 400)
 
         try:
-            user_ref = db.collection("users").document(session["user_id"])
-
-            # Get balance before transaction for display
-            current_user_snapshot_for_balance_check = user_ref.get()
-            if not current_user_snapshot_for_balance_check.exists:
-                return apology("User data error", 500)
-            balance_before_deposit = float(current_user_snapshot_for_balance_check.to_dict().get("cash", 0.0))
-            deposit_before_deposit = float(current_user_snapshot_for_balance_check.to_dict().get("deposit", 0.0))
-
-
-            @firestore.transactional
-            def deposit_cash_tx(transaction, user_doc_ref, amount_to_deposit):
-                snapshot = user_doc_ref.get(transaction=transaction)
-                if not snapshot.exists: 
-                    raise Exception("User not found")
-                user_data = snapshot.to_dict()
-                if user_data is None:
-                    raise Exception("User data is unexpectedly None in transaction")
-                new_cash = float(user_data.get("cash", 0.0)) + amount_to_deposit
-                new_deposit_total = float(user_data.get("deposit", 0.0)) + amount_to_deposit
-                transaction.update(user_doc_ref, {"cash": new_cash, "deposit": new_deposit_total})
-                return new_cash, new_deposit_total
-
-            new_balance, new_total_deposited = deposit_cash_tx(db.transaction(), user_ref, cash_to_deposit)
+            # The transaction reads the balances before and after it
+            change = unit_of_work().deposit(session["user_id"], cash_to_deposit)
 
             # Update session
-            session["balance"] = new_balance
-            session["deposit"] = new_total_deposited
+            session["balance"] = float(change.after["cash"])
+            session["deposit"] = float(change.after["deposit"])
+            portfolio_changed()
 
             flash("Cash Deposited Successfully")
             row_display = {"symbol": "Cash Deposited", "price": cash_to_deposit, "shares": 0}
-            return render_template("transaction.html", row=row_display, balance=balance_before_deposit,
+            return render_template("transaction.html", row=row_display, balance=float(change.before["cash"]),
                                    currbalance=session["balance"], username=session["username"])
         except Exception:
             return apology("currently unable to access database", 503)
@@ -681,7 +813,7 @@ def deposit():
         return render_template("deposit.html", username=session["username"])
 
 
-@app.route("/withdraw", methods=["GET", "POST"])
+@bp.route("/withdraw", methods=["GET", "POST"])
 @login_required
 def withdraw():
     """Add cash to account""" # Original comment, though "Withdraw cash" might be more apt
@@ -697,44 +829,17 @@ def withdraw():
             return apology("invalid amount", 400)
 
         try:
-            user_ref = db.collection("users").document(session["user_id"])
-
-            # Get balance before transaction for display and pre-check
-            current_user_snapshot_for_balance_check = user_ref.get()
-            if not current_user_snapshot_for_balance_check.exists:
-                return apology("User data error", 500)
-            balance_before_withdraw = float(current_user_snapshot_for_balance_check.to_dict().get("cash", 0.0))
-
-            if cash_to_withdraw > balance_before_withdraw:
-                return apology("insufficient balance", 400)
-
-            @firestore.transactional
-            def withdraw_cash_tx(transaction, user_doc_ref, amount_to_withdraw):
-                snapshot = user_doc_ref.get(transaction=transaction)
-                if not snapshot.exists: 
-                    raise Exception("User not found")
-                
-                user_data = snapshot.to_dict()
-                if user_data is None:
-                    raise Exception("User data is unexpectedly None in transaction")
-                current_cash = float(user_data.get("cash", 0.0))
-                if current_cash < amount_to_withdraw: # Double check within transaction
-                    raise ValueError("Insufficient balance for withdrawal")
-
-                new_cash = current_cash - amount_to_withdraw
-                new_withdraw_total = float(user_data.get("withdraw", 0.0)) + amount_to_withdraw
-                transaction.update(user_doc_ref, {"cash": new_cash, "withdraw": new_withdraw_total})
-                return new_cash, new_withdraw_total
-
-            new_balance, new_total_withdrawn = withdraw_cash_tx(db.transaction(), user_ref, cash_to_withdraw)
+            # The transaction checks the balance and reads it before and after
+            change = unit_of_work().withdraw(session["user_id"], cash_to_withdraw)
 
             # Update session
-            session["balance"] = new_balance
-            session["withdraw"] = new_total_withdrawn
+            session["balance"] = float(change.after["cash"])
+            session["withdraw"] = float(change.after["withdraw"])
+            portfolio_changed()
 
             flash("Cash Withdrawn Successfully")
             row_display = {"symbol": "Cash Withdrawn", "price": cash_to_withdraw, "shares": 0}
-            return render_template("transaction.html", row=row_display, balance=balance_before_withdraw,
+            return render_template("transaction.html", row=row_display, balance=float(change.before["cash"]),
                                    currbalance=session["balance"], username=session["username"])
         except ValueError as ve:
             if str(ve) == "Insufficient balance for withdrawal":
@@ -746,7 +851,7 @@ def withdraw():
         return render_template("withdraw.html", username=session["username"])
 
 
-@app.route("/profile", methods=["GET", "POST"])
+@bp.route("/profile", methods=["GET", "POST"])
 @login_required
 def profile():
     """User profile with options to change password or delete account"""
@@ -757,16 +862,13 @@ def profile():
         current_password = request.form.get("current_password")
 
         try:
-            user_ref = db.collection("users").document(session["user_id"])
-            user_snapshot = user_ref.get()
-
-            # Query database for the current user (already done by getting user_snapshot)
-            if not user_snapshot.exists:
+            # Query database for the current user
+            user_data = unit_of_work().get_user(session["user_id"])
+            if not user_data:
                 return apology("User not found", 404) # Should not happen if login_required works
-            user_data = user_snapshot.to_dict()
 
             # Ensure the current password is correct
-            if not check_password_hash(user_data.get("hash", ""), current_password):
+            if not verify_password(user_data.get("hash", ""), current_password):
                 return apology("invalid current password", 400)
 
             if action == "change_password":
@@ -791,40 +893,132 @@ def profile():
                     return apology("password must contain 8-16 characters", 400)
 
                 # Update the password in the database
-                user_ref.update({"hash": generate_password_hash(new_password)})
+                db.update_password_hash(session["user_id"], hash_password(new_password))
+                unit_of_work().forget(session["user_id"])
                 flash("Password Changed Successfully")
                 return redirect("/profile")
 
             elif action == "delete_account":
-                # Delete the user account from the database
-                # First, delete all documents in the 'history' subcollection
-                history_coll_ref = user_ref.collection('history')
-                docs_to_delete_stream = history_coll_ref.limit(500).stream() # Process in batches
-                
-                while True:
-                    batch = db.batch()
-                    doc_count_in_batch = 0
-                    for doc_del in docs_to_delete_stream:
-                        batch.delete(doc_del.reference)
-                        doc_count_in_batch +=1
-                    
-                    if doc_count_in_batch == 0: # No more documents to delete
-                        break
-                    
-                    batch.commit()
-                    
-                    if doc_count_in_batch < 500: # Last batch was processed
-                        break
-                    # Fetch next batch
-                    docs_to_delete_stream = history_coll_ref.limit(500).stream()
-
-                # Then, delete the user document itself
-                user_ref.delete()
+                # Delete the user account from the database, with its history and holdings
+                db.delete_user(session["user_id"])
+                unit_of_work().forget(session["user_id"])
                 session.clear()
                 flash("Account Deleted Successfully")
                 return redirect("/register")
+        except PasswordHashingBusy:
+            return apology("too many requests, please try again shortly", 503)
         except Exception:
             return apology("currently unable to access database", 503)
 
     # Render the profile page
     return render_template("profile.html", username=session["username"])
+
+
+@bp.cli.command("backfill-positions")
+def backfill_positions():
+    """Build every user's positions from their transaction history"""
+    if not db:
+        raise SystemExit("currently unable to access database")
+    for user_id, count in db.backfill_positions():
+        print(f"{user_id}: {count} positions")
+
+
+@bp.cli.command("compact-history")
+@click.option("--older-than", default=30, show_default=True, type=click.IntRange(min=1),
+              help="Only fold in history older than this many days.")
+@click.option("--verify", is_flag=True, help="Check the snapshots against a full scan of the history instead.")
+def compact_history(older_than, verify):
+    """Fold old transaction history into per-symbol snapshots"""
+    if not db:
+        raise SystemExit("currently unable to access database")
+    if verify:
+        failed = 0
+        for user_id, mismatches in db.verify_snapshots():
+            for mismatch in mismatches:
+                print(f"{user_id}: {mismatch['symbol']} snapshot {mismatch['snapshot']} != history {mismatch['history']}")
+            failed += bool(mismatches)
+        if failed:
+            raise SystemExit(f"{failed} users have snapshots that do not match their history")
+        print("All snapshots match the history")
+        return
+    before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=older_than)
+    for user_id, folded in db.compact_history(before):
+        print(f"{user_id}: {folded} rows folded")
+
+
+@bp.cli.command("evaluate-orders")
+def evaluate_orders():
+    """Fill resting limit and stop orders as their prices are reached, until interrupted"""
+    if not db:
+        raise SystemExit("currently unable to access database")
+    order_evaluator.storage = db
+    print(f"Evaluating resting orders every {order_evaluator.interval:g} seconds")
+    try:
+        order_evaluator.run()
+    except KeyboardInterrupt:
+        pass
+
+
+@bp.cli.command("backfill-usernames")
+def backfill_usernames():
+    """Build the usernames index from the existing users"""
+    if not db:
+        raise SystemExit("currently unable to access database")
+    count, duplicates = db.backfill_usernames()
+    print(f"{count} usernames indexed")
+    for username, user_id, owner in duplicates:
+        print(f"WARNING: {user_id} not indexed: username {username!r} already belongs to {owner}")
+    if duplicates:
+        raise SystemExit(f"{len(duplicates)} users share a username with another user; rename them and run this again")
+
+
+def warm_up_storage():
+    """Create this worker's storage client, failing if the database cannot be reached"""
+    if not db:
+        raise RuntimeError("storage is unavailable")
+
+
+def warm_up_fx_rate():
+    """Fetch the exchange rate, failing if there is none to convert quotes with"""
+    if fx_rates.get_rate() is None:
+        raise RuntimeError("no exchange rate available")
+
+
+def create_app():
+    """Create the app; clients, pools and caches are only set up later, inside each worker"""
+    app = Flask(__name__)
+
+    # Custom filters
+    app.jinja_env.filters["inr"] = inr
+    app.jinja_env.filters["sparkline"] = sparkline
+    app.jinja_env.filters["price_chart"] = lambda series: price_chart(series, inr)
+
+    # Configure session to use filesystem (instead of signed cookies)
+    app.config["SESSION_PERMANENT"] = False
+    app.config["SESSION_TYPE"] = "filesystem"
+    Session(app)
+
+    app.register_blueprint(bp)
+
+    # Per-request timing, Server-Timing headers and the /metrics endpoint
+    metrics.init_app(app)
+
+    # Keep the prices of hot symbols fresh in the background
+    refresher.init_app(app)
+
+    # Fill resting limit and stop orders as their prices are reached
+    resting_orders.init_app(app, db)
+
+    # Set up each worker before real traffic reaches it, and report when it is ready at /ready
+    warm_up = lifecycle.WarmUp()
+    warm_up.add("storage", warm_up_storage)
+    warm_up.add("quote_client", quote_client.warm_up)
+    warm_up.add("fx_rate", warm_up_fx_rate, required=False)
+    warm_up.add("symbols", symbol_index.__len__)
+    warm_up.add("password_hasher", password_hasher.warm_up)
+    lifecycle.init_app(app, warm_up)
+    return app
+
+
+# For "flask --app app" and "gunicorn app:app"
+app = create_app()
@@ -0,0 +1,98 @@
+"""Local stand-ins for the Yahoo Finance chart API and exchangerate-api
+
+Both answer with realistic payloads after a configurable delay and count
+every request they receive, so benchmarks can report upstream traffic.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeUpstreams:
+    """Serve fake chart and FX endpoints on one local port"""
+
+    def __init__(self, latency=0.05, fail_rate=0.0, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-upstreams", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def snapshot(self):
+        """Copy of the per-endpoint call counters"""
+        with self._lock:
+            return dict(self.calls)
+
+    def _count(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+
+    def _handler(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                chart = re.match(r"/chart/([^/?]+)", self.path)
+                kind = "yahoo" if chart else "fx" if "/pair/" in self.path else "other"
+                upstreams._count(kind)
+                time.sleep(upstreams.latency)
+
+                if kind == "other" or random.random() < upstreams.fail_rate:
+                    return self._send(502 if kind != "other" else 404, {"error": "unavailable"})
+                if kind == "fx":
+                    return self._send(200, {"result": "success", "conversion_rate": 83.0})
+                return self._send(200, fake_chart(chart.group(1).upper()))
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def fake_chart(symbol, days=7):
+    """Yahoo-style chart payload with a deterministic price per symbol"""
+    rng = random.Random(symbol)
+    price = round(rng.uniform(10, 500), 2)
+    now = int(time.time())
+    timestamps = [now - 86400 * i for i in range(days - 1, -1, -1)]
+    closes = [round(price * rng.uniform(0.95, 1.05), 2) for _ in timestamps[:-1]] + [price]
+    return {
+        "chart": {
+            "result": [{
+                "meta": {"symbol": symbol, "currency": "USD", "regularMarketPrice": price},
+                "timestamp": timestamps,
+                "indicators": {"quote": [{"close": closes}]}
+            }],
+            "error": None
+        }
+    }
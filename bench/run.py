@@ -0,0 +1,253 @@
+"""Load test the app against local upstream stand-ins and a SQLite datastore
+
+Usage: python -m bench.run [--holdings 100] [--history 50000] [--duration 10] ...
+
+Every scenario runs for --duration seconds with --concurrency clients and
+reports p50/p95/p99 latency, throughput and the upstream calls it caused.
+Results are written as JSON (see --output) and can be compared with an
+earlier run using --baseline.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+
+import requests
+
+from bench.fake_upstreams import FakeUpstreams
+
+
+PASSWORD = "bench!pass1"
+
+# Relative weights of the routes in the mixed scenario
+MIXED_WEIGHTS = {"index": 40, "history": 20, "search": 15, "buy": 10, "sell": 10, "sell_form": 5}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def summarize(samples, elapsed, upstream_calls):
+    latencies = sorted(latency for latency, ok in samples)
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for latency, ok in samples if not ok),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "max": latencies[-1] if latencies else None
+        },
+        "upstream_calls": upstream_calls
+    }
+
+
+def seed(db, db_path, users, holdings, history_rows):
+    """Create users with the requested number of holdings and history rows"""
+    from werkzeug.security import generate_password_hash
+
+    password_hash = generate_password_hash(PASSWORD)
+    symbols = [f"T{i:03d}" for i in range(holdings)]
+    usernames = []
+    for n in range(users):
+        username = f"benchuser{n:02d}"
+        user_id = db.create_user(username, password_hash)
+        db.deposit(user_id, 1e12)
+        usernames.append(username)
+
+        # Bulk-load history directly; positions are then rebuilt from it
+        conn = sqlite3.connect(db_path)
+        now = time.time()
+        rows = []
+        for i in range(max(history_rows, holdings)):
+            symbol = symbols[i % holdings]
+            shares = random.randint(1, 5)
+            price = round(random.uniform(800, 40000), 2)
+            rows.append((user_id, symbol, price, shares, price * shares, "buy", now - (history_rows - i) * 60))
+        with conn:
+            conn.executemany("INSERT INTO history (user_id, symbol, price, shares, total, type, time) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.close()
+    for _ in db.backfill_positions():
+        pass
+    return usernames, symbols
+
+
+def login(base_url, username):
+    client = requests.Session()
+    response = client.post(f"{base_url}/login", data={"username": username, "password": PASSWORD}, allow_redirects=False)
+    if response.status_code != 302:
+        raise SystemExit(f"could not log in {username}")
+    return client
+
+
+def make_request(client, base_url, route, symbols):
+    symbol = random.choice(symbols)
+    if route == "index":
+        return client.get(f"{base_url}/")
+    elif route == "history":
+        return client.get(f"{base_url}/history")
+    elif route == "search":
+        return client.post(f"{base_url}/search", data={"symbol": symbol})
+    elif route == "buy":
+        return client.post(f"{base_url}/buy", data={"symbol": symbol, "shares": "1"})
+    elif route == "sell":
+        return client.post(f"{base_url}/sell", data={"symbol": symbol, "shares": "1"})
+    elif route == "sell_form":
+        return client.get(f"{base_url}/sell")
+    raise ValueError(f"unknown route: {route}")
+
+
+def run_scenario(scenario, clients, base_url, symbols, duration, concurrency):
+    """Drive traffic for one scenario and return the samples per route"""
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    routes, weights = zip(*MIXED_WEIGHTS.items())
+
+    def worker(n):
+        client = clients[n % len(clients)]
+        while time.perf_counter() < deadline:
+            route = random.choices(routes, weights)[0] if scenario == "mixed" else scenario
+            start = time.perf_counter()
+            try:
+                response = make_request(client, base_url, route, symbols)
+                ok = response.status_code == 200 and "(Error Code:" not in response.text
+            except requests.RequestException:
+                ok = False
+            latency = round((time.perf_counter() - start) * 1000, 3)
+            with lock:
+                samples[route].append((latency, ok))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    """Print p95 latency and throughput changes against an earlier run"""
+    print(f"\nChange against {baseline['commit']} ({baseline['started_at']}):")
+    for scenario, data in results["scenarios"].items():
+        before = baseline["scenarios"].get(scenario)
+        if not before:
+            continue
+        for route, stats in data["routes"].items():
+            old = before["routes"].get(route)
+            if not old or not old["latency_ms"]["p95"] or not stats["latency_ms"]["p95"]:
+                continue
+            p95 = (stats["latency_ms"]["p95"] / old["latency_ms"]["p95"] - 1) * 100
+            rps = (stats["throughput_rps"] / old["throughput_rps"] - 1) * 100 if old["throughput_rps"] else 0.0
+            print(f"  {scenario:>9} {route:<10} p95 {p95:+7.1f}%   throughput {rps:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=4, help="number of accounts sharing the load")
+    parser.add_argument("--holdings", type=int, default=100, help="distinct symbols held by each account")
+    parser.add_argument("--history", type=int, default=50000, help="history rows per account")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="seconds the fake upstreams take to answer")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of upstream calls that fail")
+    parser.add_argument("--scenarios", default="index,history,search,buy,sell,mixed",
+                        help="comma-separated routes to load one at a time, plus 'mixed'")
+    parser.add_argument("--output", help="where to write the JSON results (default: bench/results/<time>.json)")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                             datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"))
+
+    upstreams = FakeUpstreams(latency=args.upstream_latency, fail_rate=args.fail_rate).start()
+    workdir = tempfile.mkdtemp(prefix="webquity-bench-")
+    db_path = os.path.join(workdir, "bench.db")
+
+    # Configure the app before it is imported
+    os.environ.update({
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_PATH": db_path,
+        "YAHOO_CHART_URL": f"{upstreams.url}/chart",
+        "FX_API_URL": f"{upstreams.url}/fx",
+        "API_KEY": "bench"
+    })
+    os.chdir(workdir) # Flask-Session keeps its files in the working directory
+    import quotes
+    from app import app, db
+    from werkzeug.serving import make_server
+
+    print(f"Seeding {args.users} users with {args.holdings} holdings and {args.history} history rows each...")
+    usernames, symbols = seed(db, db_path, args.users, args.holdings, args.history)
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    clients = [login(base_url, username) for username in usernames]
+
+    results = {
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "scenarios": {}
+    }
+    for scenario in args.scenarios.split(","):
+        # Start every scenario cold so upstream counts are comparable
+        quotes.quote_cache.clear()
+        before = upstreams.snapshot()
+        start = time.perf_counter()
+        samples = run_scenario(scenario, clients, base_url, symbols, args.duration, args.concurrency)
+        elapsed = time.perf_counter() - start
+        after = upstreams.snapshot()
+        upstream_calls = {kind: after.get(kind, 0) - before.get(kind, 0) for kind in after}
+
+        all_samples = [sample for route_samples in samples.values() for sample in route_samples]
+        results["scenarios"][scenario] = summarize(all_samples, elapsed, upstream_calls)
+        results["scenarios"][scenario]["routes"] = {route: summarize(route_samples, elapsed, None)
+                                                    for route, route_samples in samples.items()}
+        stats = results["scenarios"][scenario]
+        print(f"{scenario:>9}: {stats['requests']:6d} req  {stats['throughput_rps']:8.1f} req/s  "
+              f"p50 {stats['latency_ms']['p50']} ms  p95 {stats['latency_ms']['p95']} ms  "
+              f"p99 {stats['latency_ms']['p99']} ms  errors {stats['errors']}  upstream {upstream_calls}")
+
+    server.shutdown()
+    upstreams.stop()
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""Compact daily price series and the inline SVG charts drawn from them
+
+Yahoo's chart API already returns the last 7 daily closes with every
+quote, so they are kept with the quote in the quote cache (as two flat
+arrays) and drawn server-side instead of loading third-party chart images.
+"""
+
+import datetime
+
+from array import array
+
+from markupsafe import Markup
+
+
+class PriceSeries:
+    """Daily closing prices, as parallel arrays of epoch seconds and prices"""
+
+    __slots__ = ("timestamps", "closes")
+
+    def __init__(self, timestamps=(), closes=()):
+        self.timestamps = array("q", timestamps)
+        self.closes = array("d", closes)
+
+    @classmethod
+    def from_chart(cls, result):
+        """Build a series from one Yahoo chart result, skipping days without a close"""
+        try:
+            timestamps = result.get("timestamp") or []
+            closes = result["indicators"]["quote"][0].get("close") or []
+        except (KeyError, IndexError, TypeError, AttributeError):
+            return cls()
+        points = [(int(t), float(c)) for t, c in zip(timestamps, closes) if t is not None and c is not None]
+        return cls((t for t, c in points), (c for t, c in points))
+
+    def scaled(self, factor):
+        """Return the series with every price multiplied by factor, e.g. to convert currency"""
+        series = PriceSeries()
+        series.timestamps = self.timestamps
+        series.closes = array("d", (close * factor for close in self.closes))
+        return series
+
+    def __len__(self):
+        return len(self.closes)
+
+
+# Brand colors (see static/styles.css)
+UP_COLOR = "#2e944b"
+DOWN_COLOR = "#ea433b"
+
+
+def _points(series, width, height, pad):
+    low, high = min(series.closes), max(series.closes)
+    spread = (high - low) or 1.0
+    step = (width - 2 * pad) / (len(series) - 1)
+    return " ".join(f"{pad + i * step:.1f},{pad + (high - close) / spread * (height - 2 * pad):.1f}"
+                    for i, close in enumerate(series.closes))
+
+
+def sparkline(series, width=120, height=32):
+    """Small inline SVG line of the series, green if it ended up and red if down"""
+    if series is None or len(series) < 2:
+        return ""
+    color = UP_COLOR if series.closes[-1] >= series.closes[0] else DOWN_COLOR
+    return Markup(
+        f'<svg class="sparkline" width="{width}" height="{height}" viewBox="0 0 {width} {height}" role="img" '
+        f'aria-label="Last {len(series)} days">'
+        f'<polyline fill="none" stroke="{color}" stroke-width="1.5" points="{_points(series, width, height, 2)}"/></svg>'
+    )
+
+
+def price_chart(series, format_price, width=580, height=240):
+    """Larger inline SVG chart of the series, labelled with its dates and price range"""
+    if series is None or len(series) < 2:
+        return ""
+    pad = 24
+    color = UP_COLOR if series.closes[-1] >= series.closes[0] else DOWN_COLOR
+    first, last = (datetime.datetime.fromtimestamp(t, datetime.timezone.utc).strftime("%d %b")
+                   for t in (series.timestamps[0], series.timestamps[-1]))
+    return Markup(
+        f'<svg class="price-chart" width="100%" viewBox="0 0 {width} {height}" role="img" '
+        f'aria-label="Closing prices, {first} to {last}">'
+        f'<polyline fill="none" stroke="{color}" stroke-width="2" points="{_points(series, width, height, pad)}"/>'
+        f'<text x="{pad}" y="14" font-size="12">{Markup.escape(format_price(max(series.closes)))}</text>'
+        f'<text x="{pad}" y="{height - 4}" font-size="12">{Markup.escape(format_price(min(series.closes)))}</text>'
+        f'<text x="{width - pad}" y="{height - 4}" font-size="12" text-anchor="end">{first} – {last}</text>'
+        f'</svg>'
+    )
@@ -0,0 +1,89 @@
+"""Per-worker warm-up hooks and the readiness endpoint
+
+Clients, pools and caches are created lazily inside each worker process,
+never before a preforking server forks. Warm-up hooks create them ahead
+of real traffic, in a background thread started by the first request or
+readiness probe a worker receives; /ready answers 503 until they are done.
+Required hooks that fail are retried with backoff, so a worker that booted
+during a brief outage becomes ready once its dependencies are back.
+"""
+
+import os
+import threading
+import time
+
+from flask import jsonify
+
+
+class WarmUp:
+    """Run a list of start-up hooks once per worker process
+
+    A failing required hook keeps the worker unready and is run again after
+    retry_initial seconds, doubling up to retry_max; optional hooks (e.g.
+    for upstreams the app can run without) are reported but do not, and
+    are not retried.
+    """
+
+    def __init__(self, retry_initial=1.0, retry_max=30.0):
+        self.hooks = [] # (name, fn, required)
+        self.retry_initial = retry_initial
+        self.retry_max = retry_max
+        self._forget()
+        # A forked child warms up again on its own
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        self.results = {}
+        self._thread = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def add(self, name, fn, required=True):
+        self.hooks.append((name, fn, required))
+
+    def start(self):
+        """Run the hooks in the background, unless they already ran in this process"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+                self._thread.start()
+
+    def _run_hook(self, name, fn, required):
+        attempts = self.results.get(name, {}).get("attempts", 0) + 1
+        start = time.perf_counter()
+        try:
+            fn()
+            result = {"ok": True}
+        except Exception as e:
+            print(f"WARNING: Warm-up step {name} failed (attempt {attempts}): {e!r}")
+            result = {"ok": False, "error": repr(e)}
+        result.update({"required": required, "attempts": attempts, "seconds": round(time.perf_counter() - start, 3)})
+        self.results[name] = result
+        return result["ok"]
+
+    def _run(self):
+        failed = [(name, fn, required) for name, fn, required in self.hooks
+                  if not self._run_hook(name, fn, required) and required]
+        self._done.set()
+        # Retry the required steps that failed until they all pass
+        delay = self.retry_initial
+        while failed:
+            time.sleep(delay)
+            delay = min(delay * 2, self.retry_max)
+            failed = [hook for hook in failed if not self._run_hook(*hook)]
+
+    def ready(self):
+        return self._done.is_set() and all(result["ok"] for result in self.results.values() if result["required"])
+
+
+def init_app(app, warm_up):
+    """Start warm-up with the first request and serve the readiness endpoint"""
+    app.extensions["warm_up"] = warm_up
+
+    def readiness():
+        warm_up.start()
+        ready = warm_up.ready()
+        return jsonify({"ready": ready, "checks": warm_up.results}), 200 if ready else 503
+
+    app.before_request(warm_up.start)
+    app.add_url_rule("/ready", "ready", readiness)
@@ -0,0 +1,234 @@
+"""Request timing spans and Prometheus metrics
+
+Code anywhere in a request can time a block with ``with span("db"):``.
+Each request's spans are exported as a per-route histogram and returned
+to the browser in a Server-Timing header; /metrics exposes everything in
+the Prometheus text format.
+"""
+
+import contextvars
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, g, request, template_rendered, before_render_template
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+REQUEST_LATENCY = Histogram("webquity_request_seconds", "Time spent handling a request",
+                            ["route", "method", "status"])
+SPAN_LATENCY = Histogram("webquity_span_seconds", "Time spent in one part of a request",
+                         ["route", "span"])
+UPSTREAM_CALLS = Counter("webquity_upstream_calls_total", "Calls made to the quote and FX APIs",
+                         ["upstream", "outcome"])
+PASSWORD_HASH_LATENCY = Histogram("webquity_password_hash_seconds",
+                                  "Time to hash or check a password, including waiting for a free process",
+                                  ["operation", "outcome"])
+DB_DOCUMENTS = Counter("webquity_db_documents_total", "Documents (or rows) read and written by the storage backend",
+                       ["backend", "operation"])
+DB_READS_SAVED = Counter("webquity_db_reads_saved_total", "Document reads answered from the request's unit of work",
+                         ["route"])
+
+# Per-request span totals: span name -> [seconds, count]
+_timings = contextvars.ContextVar("timings", default=None)
+_route = contextvars.ContextVar("route", default="none")
+
+
+def record_span(name, elapsed):
+    """Add elapsed seconds to a span of the current request"""
+    timings = _timings.get()
+    if timings is not None:
+        total = timings.setdefault(name, [0.0, 0])
+        total[0] += elapsed
+        total[1] += 1
+    SPAN_LATENCY.labels(_route.get(), name).observe(elapsed)
+
+
+@contextmanager
+def span(name):
+    """Time a block of code as part of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def count_upstream(upstream, outcome):
+    UPSTREAM_CALLS.labels(upstream, outcome).inc()
+
+
+def record_hash(operation, outcome, elapsed):
+    PASSWORD_HASH_LATENCY.labels(operation, outcome).observe(elapsed)
+
+
+def count_documents(backend, operation, count=1):
+    if count:
+        DB_DOCUMENTS.labels(backend, operation).inc(count)
+
+
+def count_saved_read():
+    DB_READS_SAVED.labels(_route.get()).inc()
+
+
+class CacheCollector:
+    """Export the quote cache and FX provider counters at scrape time
+
+    Running totals are exported as counters (with a _total suffix) and
+    current sizes and states as gauges. Every figure is this worker
+    process's own.
+    """
+
+    def collect(self):
+        from quotes import fx_breaker, fx_rates, invalid_symbols, quote_cache, quote_flights, yahoo_breaker
+        from portfolio import portfolio_cache
+        from price_stream import price_hub
+        from refresher import price_refresher
+        from resting_orders import order_evaluator
+
+        stats = quote_cache.stats()
+        for name, help_text in (("hits", "Quote cache hits"), ("misses", "Quote cache misses"),
+                                ("stale_hits", "Expired quotes served while being revalidated")):
+            yield CounterMetricFamily(f"webquity_quote_cache_{name}", help_text, value=stats[name])
+        yield GaugeMetricFamily("webquity_quote_cache_hit_ratio", "Share of quote lookups served from the cache",
+                                value=stats["hit_ratio"])
+        yield GaugeMetricFamily("webquity_quote_cache_size", "Symbols currently in the quote cache", value=stats["size"])
+
+        stats = quote_flights.stats()
+        yield CounterMetricFamily("webquity_quote_fetches", "Upstream quote fetches started", value=stats["calls"])
+        yield CounterMetricFamily("webquity_quote_fetches_coalesced",
+                                  "Quote lookups that waited on a fetch already in flight", value=stats["coalesced"])
+        yield GaugeMetricFamily("webquity_quote_fetches_in_flight", "Upstream quote fetches in flight",
+                                value=stats["in_flight"])
+
+        stats = invalid_symbols.stats()
+        yield CounterMetricFamily("webquity_invalid_symbol_hits", "Lookups of known invalid symbols answered without Yahoo",
+                                  value=stats["hits"])
+        yield GaugeMetricFamily("webquity_invalid_symbols", "Invalid symbols currently remembered", value=stats["size"])
+
+        open_gauge = GaugeMetricFamily("webquity_upstream_circuit_open", "Whether an upstream's circuit breaker is open",
+                                       labels=["upstream"])
+        trips = CounterMetricFamily("webquity_upstream_circuit_trips", "Times an upstream's circuit breaker has opened",
+                                    labels=["upstream"])
+        for breaker in (yahoo_breaker, fx_breaker):
+            open_gauge.add_metric([breaker.name], 1 if breaker.is_open() else 0)
+            trips.add_metric([breaker.name], breaker.trips)
+        yield open_gauge
+        yield trips
+
+        stats = portfolio_cache.stats()
+        for name, help_text in (("hits", "Portfolio figures served from a cached valuation"),
+                                ("misses", "Portfolio figures that were not cached"),
+                                ("invalidations", "Cached portfolio valuations dropped after a transaction"),
+                                ("repriced", "Cached portfolio valuations repriced by a new quote")):
+            yield CounterMetricFamily(f"webquity_portfolio_cache_{name}", help_text, value=stats[name])
+        yield GaugeMetricFamily("webquity_portfolio_cache_size", "Users with a cached portfolio valuation",
+                                value=stats["size"])
+
+        stats = fx_rates.stats()
+        yield CounterMetricFamily("webquity_fx_refreshes", "Successful exchange rate refreshes", value=stats["refreshes"])
+        yield CounterMetricFamily("webquity_fx_failures", "Failed exchange rate refreshes", value=stats["failures"])
+        if stats["age"] is not None:
+            yield GaugeMetricFamily("webquity_fx_rate_age_seconds", "Age of the exchange rate in use", value=stats["age"])
+
+        stats = price_hub.stats()
+        for name, help_text in (("subscribers", "Open live price streams"), ("symbols", "Symbols watched by live price streams")):
+            yield GaugeMetricFamily(f"webquity_price_stream_{name}", help_text, value=stats[name])
+        for name, help_text in (("published", "Quotes fanned out to live price streams"),
+                                ("delivered", "Price updates queued for live price streams"),
+                                ("refused", "Live price streams refused at the subscriber limit")):
+            yield CounterMetricFamily(f"webquity_price_stream_{name}", help_text, value=stats[name])
+
+        stats = order_evaluator.stats()
+        for name, help_text in (("filled", "Resting orders filled"), ("rejected", "Resting orders that could not be filled")):
+            yield CounterMetricFamily(f"webquity_resting_orders_{name}", help_text, value=stats[name])
+        yield GaugeMetricFamily("webquity_resting_orders_open", "Open resting orders in this worker's book",
+                                value=stats["open"])
+
+        stats = price_refresher.stats()
+        yield CounterMetricFamily("webquity_price_refresher_refreshed", "Quotes refreshed in the background",
+                                  value=stats["refreshed"])
+        yield CounterMetricFamily("webquity_price_refresher_failed", "Background quote refreshes that failed",
+                                  value=stats["failed"])
+        yield GaugeMetricFamily("webquity_price_refresher_delay_seconds", "Current delay between refresh rounds",
+                                value=stats["delay"])
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_tokens = (_timings.set({}), _route.set(request.url_rule.rule if request.url_rule else "none"))
+
+
+def _finish_request(response):
+    if "metrics_start" not in g:
+        return response
+    elapsed = time.perf_counter() - g.metrics_start
+    REQUEST_LATENCY.labels(_route.get(), request.method, response.status_code).observe(elapsed)
+
+    timings = _timings.get() or {}
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, (seconds, count) in timings.items()]
+    entries.append(f"total;dur={elapsed * 1000:.1f}")
+    response.headers["Server-Timing"] = ", ".join(entries)
+    return response
+
+
+def _reset_request(exc):
+    tokens = g.pop("metrics_tokens", None)
+    if tokens:
+        _timings.reset(tokens[0])
+        _route.reset(tokens[1])
+
+
+def _start_render(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+
+def _finish_render(sender, template, context, **extra):
+    start = g.pop("render_start", None)
+    if start is not None:
+        record_span("render", time.perf_counter() - start)
+
+
+class TimedProxy:
+    """Wrap every method call on an object in a span, e.g. to time all database access"""
+
+    def __init__(self, target, name):
+        self._target = target
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+
+        @wraps(value)
+        def timed(*args, **kwargs):
+            with span(self._name):
+                return value(*args, **kwargs)
+
+        return timed
+
+
+def metrics_endpoint():
+    """Expose all metrics in the Prometheus text format"""
+    return Response(generate_latest(REGISTRY), mimetype=CONTENT_TYPE_LATEST)
+
+
+_collector = None
+
+
+def init_app(app):
+    """Install the timing hooks and the /metrics endpoint on the app"""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_reset_request)
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_finish_render, app)
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint)
+    global _collector
+    # The collector is process-wide, while init_app runs once per app created
+    if _collector is None:
+        _collector = CacheCollector()
+        REGISTRY.register(_collector)
@@ -0,0 +1,156 @@
+"""Password hashing off the request threads
+
+Hashing is CPU-bound and holds the GIL, so it runs in a small process
+pool instead. At most PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE hashes
+are accepted at once; beyond that callers get PasswordHashingBusy right
+away rather than queueing behind a login burst. The pool is started on
+first use, i.e. inside the worker process.
+"""
+
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from metrics import record_hash, span
+
+
+load_dotenv()
+# Hash method and salt length for new hashes, in werkzeug's format with every parameter spelled
+# out as in stored hashes (e.g. "scrypt:32768:8:1", "pbkdf2:sha256:600000"); older hashes are
+# replaced at the next login
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_SALT_LENGTH = int(os.getenv("PASSWORD_SALT_LENGTH", "16"))
+# Processes hashing passwords (0 hashes on the request thread instead)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# Hashes that may wait for a free process before new ones are refused
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "32"))
+# Seconds to wait for a hash before giving up
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "10"))
+
+
+class PasswordHashingBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed"""
+
+
+class PasswordHasher:
+    """Hash and check passwords in a bounded process pool"""
+
+    def __init__(self, method, salt_length, workers, queue_size, timeout):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self._forget()
+        # A forked child cannot use its parent's pool
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # Spawned (not forked) processes inherit none of the app's threads or sockets
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _discard(self, pool):
+        """Drop a pool whose process died, so the next hash starts a new one"""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, operation, fn, *args):
+        start = time.perf_counter()
+        with span("hash"):
+            if not self.workers:
+                result = fn(*args)
+            else:
+                if not self._slots.acquire(blocking=False):
+                    record_hash(operation, "busy", time.perf_counter() - start)
+                    raise PasswordHashingBusy()
+                pool = self._executor()
+                try:
+                    future = pool.submit(fn, *args)
+                except BrokenProcessPool:
+                    self._slots.release()
+                    self._discard(pool)
+                    record_hash(operation, "broken", time.perf_counter() - start)
+                    raise PasswordHashingBusy()
+                except BaseException:
+                    self._slots.release()
+                    raise
+                # The slot is held until the hash is done, even if this caller stops waiting for it
+                future.add_done_callback(lambda future: self._slots.release())
+                try:
+                    result = future.result(self.timeout)
+                except TimeoutError:
+                    record_hash(operation, "timeout", time.perf_counter() - start)
+                    raise PasswordHashingBusy()
+                except BrokenProcessPool:
+                    # A hashing process was killed (e.g. out of memory)
+                    self._discard(pool)
+                    record_hash(operation, "broken", time.perf_counter() - start)
+                    raise PasswordHashingBusy()
+        # Includes the time spent waiting for a free process
+        record_hash(operation, "ok", time.perf_counter() - start)
+        return result
+
+    def hash(self, password):
+        """Hash a password for storage with the configured method"""
+        return self._run("hash", generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        """Check a password against its stored hash"""
+        return self._run("verify", check_password_hash, pwhash, password)
+
+    def warm_up(self):
+        """Start the hashing processes ahead of the first login"""
+        if self.workers:
+            pool = self._executor()
+            for future in [pool.submit(len, "") for _ in range(self.workers)]:
+                future.result(self.timeout)
+
+    def needs_rehash(self, pwhash):
+        """Return whether a stored hash was made with other parameters than the configured ones"""
+        method, _, rest = pwhash.partition("$")
+        salt = rest.partition("$")[0]
+        return method != self.method or len(salt) != self.salt_length
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, PASSWORD_SALT_LENGTH, PASSWORD_HASH_WORKERS,
+                                 PASSWORD_HASH_QUEUE, PASSWORD_HASH_TIMEOUT)
+atexit.register(password_hasher.shutdown)
+
+
+def hash_password(password):
+    """Hash a password for storage"""
+    return password_hasher.hash(password)
+
+
+def verify_password(pwhash, password):
+    """Check a password against its stored hash"""
+    return password_hasher.verify(pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return password_hasher.needs_rehash(pwhash)
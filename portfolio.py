@@ -0,0 +1,230 @@
+"""Cached portfolio valuations, one per user
+
+The dashboard and the history header show a user's balances, holdings and
+their current value. Working those out reads the user and their positions
+and prices every holding, so the result is kept per user (per worker
+process) as a Valuation:
+
+- a buy, sell, deposit or withdraw by the user invalidates it
+- every quote stored in the quote cache (by the background refresher or
+  any lookup) is noted, and the valuations holding that symbol are
+  repriced at it when next read
+- prices older than the quote cache TTL are looked up again, without
+  reading the positions again
+
+Positions changed through another worker are caught by the version kept in
+the user's session, or at the latest after PORTFOLIO_CACHE_TTL seconds.
+"""
+
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from quotes import QUOTE_CACHE_TTL, fx_rates, hot_symbols, lookup_many, quote_cache, to_inr
+
+
+# Seconds a user's positions and balances are reused before they are read again
+PORTFOLIO_CACHE_TTL = float(os.getenv("PORTFOLIO_CACHE_TTL", "300"))
+# Maximum number of users whose valuation is kept
+PORTFOLIO_CACHE_SIZE = int(os.getenv("PORTFOLIO_CACHE_SIZE", "10000"))
+
+
+class Valuation:
+    """One user's balances and holdings, priced at a point in time
+
+    Valuations are never changed once made; repricing makes a new one.
+    """
+
+    def __init__(self, user, positions, quotes, priced_at, computed_at=None):
+        self.balance = float(user.get("cash", 0.0))
+        self.deposit = float(user.get("deposit", 0.0))
+        self.withdraw = float(user.get("withdraw", 0.0))
+        self._user = user
+        # Holdings that still hold shares, as dicts of symbol, shares and cost_basis
+        self.positions = [position for position in positions if position["shares"] > 0]
+        self.quotes = quotes # symbol -> INR quote; held symbols that could not be priced are missing
+        self.priced_at = priced_at # symbol -> time.monotonic() its price was taken
+        self.computed_at = computed_at if computed_at is not None else time.monotonic()
+        self.rows, self.total = self._value()
+
+    def _value(self):
+        rows = []
+        total = 0.0
+        for position in self.positions:
+            symbol, shares = position["symbol"], position["shares"]
+            # 'cost_basis' is the sum of the history 'total's for the symbol:
+            # positive cost for buys and negative proceeds for sells.
+            avg_cost_price = position.get("cost_basis", 0) / shares
+            quote = self.quotes.get(symbol)
+            if quote:
+                rows.append({"symbol": symbol, "shares": shares, "price": quote["price"], "oldprice": avg_cost_price,
+                             "total": quote["price"] * shares, "series": quote["series"], "stale": quote["stale"]})
+                total += quote["price"] * shares
+            else:
+                # Shown as N/A and left out of the total
+                rows.append({"symbol": symbol, "shares": shares, "price": None, "oldprice": avg_cost_price,
+                             "total": None, "series": None})
+        return rows, total
+
+    def symbols(self):
+        return [position["symbol"] for position in self.positions]
+
+    def unpriced(self, max_age):
+        """Return the held symbols whose price is missing, stale or older than max_age seconds"""
+        cutoff = time.monotonic() - max_age
+        return [symbol for symbol in self.symbols()
+                if symbol not in self.quotes or self.quotes[symbol]["stale"] or self.priced_at[symbol] < cutoff]
+
+    def repriced(self, quotes):
+        """Return a copy with the given symbols repriced at these quotes (None leaves a symbol unpriced)"""
+        now = time.monotonic()
+        merged = {symbol: quote for symbol, quote in {**self.quotes, **quotes}.items() if quote is not None}
+        return Valuation(self._user, self.positions, merged, {**self.priced_at, **{symbol: now for symbol in quotes}},
+                         self.computed_at)
+
+
+def value_portfolio(user, positions):
+    """Price a user's positions into a Valuation"""
+    valuation = Valuation(user, positions, {}, {})
+    # Price every holding in one batch, against the same exchange rate snapshot
+    return valuation.repriced(lookup_many(valuation.symbols()))
+
+
+class PortfolioCache:
+    """Process-wide LRU cache of valuations keyed by user ID and version
+
+    The version of the user's positions is kept by the caller (e.g. in the
+    session); each version is cached separately, so sessions of one user
+    at different versions do not evict each other.
+
+    New quotes are only noted as they arrive; each valuation holding the
+    symbol is repriced the next time it is read.
+    """
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.repriced = 0
+        self._entries = OrderedDict() # (user ID, version) -> (valuation, tick it was priced up to)
+        self._keys = {} # user ID -> keys of their cached valuations
+        self._holders = {} # symbol -> keys of the cached valuations holding it
+        self._ticks = 0 # quotes noted so far
+        self._latest = {} # held symbol -> (tick, newest USD quote)
+        self._lock = threading.Lock()
+
+    def _drop(self, key):
+        # Called with the lock held
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys[key[0]]
+        for symbol in entry[0].symbols():
+            holders = self._holders.get(symbol)
+            if holders is not None:
+                holders.discard(key)
+                if not holders:
+                    del self._holders[symbol]
+                    self._latest.pop(symbol, None)
+
+    def get(self, user_id, version):
+        """Return the user's cached valuation for this version, repriced at any newer quotes, or None"""
+        key = (user_id, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0].computed_at > self.ttl:
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            valuation, seen = entry
+            ticked = {symbol: self._latest[symbol] for symbol in valuation.symbols()
+                      if symbol in self._latest and self._latest[symbol][0] > seen}
+        if not ticked:
+            return valuation
+
+        fx_rate = fx_rates.get_rate()
+        if fx_rate is None:
+            return valuation
+        # Repriced by the reader, outside the lock
+        repriced = valuation.repriced({symbol: to_inr(quote, fx_rate) for symbol, (tick, quote) in ticked.items()})
+        with self._lock:
+            if self._entries.get(key) is entry:
+                self._entries[key] = (repriced, max(tick for tick, quote in ticked.values()))
+                self.repriced += 1
+        return repriced
+
+    def put(self, user_id, version, valuation):
+        key = (user_id, version)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (valuation, self._ticks)
+            self._keys.setdefault(user_id, set()).add(key)
+            for symbol in valuation.symbols():
+                self._holders.setdefault(symbol, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, user_id):
+        """Forget every cached valuation of the user, e.g. after they traded or moved cash"""
+        with self._lock:
+            keys = list(self._keys.get(user_id, ()))
+            if keys:
+                self.invalidations += 1
+            for key in keys:
+                self._drop(key)
+
+    def price_tick(self, symbol, quote):
+        """Note a newly fetched USD quote for the valuations holding symbol to be repriced at when next read"""
+        with self._lock:
+            if symbol in self._holders:
+                self._ticks += 1
+                self._latest[symbol] = (self._ticks, quote)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self._holders.clear()
+            self._latest.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "repriced": self.repriced,
+                "size": len(self._entries)
+            }
+
+
+portfolio_cache = PortfolioCache(PORTFOLIO_CACHE_TTL, PORTFOLIO_CACHE_SIZE)
+quote_cache.subscribe(portfolio_cache.price_tick)
+
+
+def cached_valuation(user_id, version):
+    """Return the user's cached valuation, with any outdated prices looked up again, or None"""
+    valuation = portfolio_cache.get(user_id, version)
+    if valuation is None:
+        return None
+    unpriced = valuation.unpriced(QUOTE_CACHE_TTL)
+    if unpriced:
+        # Lookups that fail leave their symbol unpriced rather than showing an outdated price as current
+        quotes = lookup_many(unpriced)
+        valuation = valuation.repriced({symbol: quotes.get(symbol) for symbol in unpriced})
+        portfolio_cache.put(user_id, version, valuation)
+    else:
+        # Keep the holdings refreshed in the background while their owner is watching
+        hot_symbols.touch(valuation.symbols())
+    return valuation
@@ -0,0 +1,144 @@
+"""Live prices pushed to browsers over Server-Sent Events
+
+Every quote stored in the quote cache is converted to INR once and fanned
+out by an in-process hub to the streams subscribed to its symbol, so a
+symbol watched by many users still costs one upstream fetch per refresh
+(made by the background refresher, which keeps subscribed symbols hot).
+A subscriber only keeps the latest update per symbol, so a slow client
+never holds more than one pending update per symbol it watches.
+"""
+
+import json
+import os
+import threading
+
+from quotes import fx_rates, hot_symbols, quote_cache, to_inr
+
+
+# Threads each worker process serves requests with (as in gunicorn --threads)
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "100"))
+# Streams one worker process serves at once; more are refused until one closes. Every stream holds
+# a thread for as long as it is open, so at most half of them may stream and the rest keep serving
+# pages, logins and readiness probes.
+PRICE_STREAM_MAX_SUBSCRIBERS = int(os.getenv("PRICE_STREAM_MAX_SUBSCRIBERS", str(WORKER_THREADS // 2)))
+if PRICE_STREAM_MAX_SUBSCRIBERS > WORKER_THREADS // 2:
+    print(f"WARNING: PRICE_STREAM_MAX_SUBSCRIBERS={PRICE_STREAM_MAX_SUBSCRIBERS} would leave too few of the "
+          f"{WORKER_THREADS} worker threads for other requests, using {WORKER_THREADS // 2}")
+    PRICE_STREAM_MAX_SUBSCRIBERS = WORKER_THREADS // 2
+# Seconds between heartbeats on a quiet stream (which also notice closed connections)
+PRICE_STREAM_HEARTBEAT = float(os.getenv("PRICE_STREAM_HEARTBEAT", "15"))
+# Most symbols one stream may watch
+PRICE_STREAM_SYMBOLS_MAX = int(os.getenv("PRICE_STREAM_SYMBOLS_MAX", "100"))
+
+
+class StreamsFull(Exception):
+    """Raised when a worker already serves its maximum number of price streams"""
+
+
+class Subscription:
+    """The symbols one stream watches and the updates waiting to be sent to it"""
+
+    def __init__(self, symbols):
+        self.symbols = frozenset(symbols)
+        self._pending = {} # symbol -> latest update not yet sent
+        self._ready = threading.Condition()
+
+    def push(self, update):
+        with self._ready:
+            self._pending[update["symbol"]] = update
+            self._ready.notify()
+
+    def wait(self, timeout):
+        """Return the pending updates, waiting up to timeout seconds for one (empty on timeout)"""
+        with self._ready:
+            self._ready.wait_for(lambda: self._pending, timeout)
+            updates, self._pending = list(self._pending.values()), {}
+        return updates
+
+
+class PriceHub:
+    """Fan quotes out to the subscriptions watching their symbol"""
+
+    def __init__(self, max_subscribers):
+        self.max_subscribers = max_subscribers
+        self.published = 0
+        self.delivered = 0
+        self.refused = 0
+        self._subscriptions = set()
+        self._by_symbol = {} # symbol -> subscriptions watching it
+        self._lock = threading.Lock()
+
+    def subscribe(self, symbols):
+        """Start a subscription to symbols, seeded with their cached quotes; raise StreamsFull at the limit"""
+        subscription = Subscription(symbols)
+        with self._lock:
+            if len(self._subscriptions) >= self.max_subscribers:
+                self.refused += 1
+                raise StreamsFull()
+            self._subscriptions.add(subscription)
+            for symbol in subscription.symbols:
+                self._by_symbol.setdefault(symbol, set()).add(subscription)
+        # Catch the page up with anything fetched since it was rendered
+        fx_rate = fx_rates.get_rate()
+        if fx_rate is not None:
+            for symbol in subscription.symbols:
+                quote = quote_cache.get(symbol)
+                if quote is not None:
+                    subscription.push(self._update(to_inr(quote, fx_rate)))
+        hot_symbols.touch(subscription.symbols)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            for symbol in subscription.symbols:
+                watchers = self._by_symbol.get(symbol)
+                if watchers is not None:
+                    watchers.discard(subscription)
+                    if not watchers:
+                        del self._by_symbol[symbol]
+
+    @staticmethod
+    def _update(quote):
+        return {"symbol": quote["symbol"], "price": quote["price"], "stale": quote["stale"]}
+
+    def publish(self, symbol, quote):
+        """Send a newly stored USD quote to every subscription watching its symbol"""
+        with self._lock:
+            watchers = list(self._by_symbol.get(symbol, ()))
+        if not watchers:
+            return
+        fx_rate = fx_rates.get_rate()
+        if fx_rate is None:
+            return
+        update = self._update(to_inr(quote, fx_rate))
+        for subscription in watchers:
+            subscription.push(update)
+        self.published += 1
+        self.delivered += len(watchers)
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers": len(self._subscriptions), "symbols": len(self._by_symbol),
+                    "published": self.published, "delivered": self.delivered, "refused": self.refused}
+
+
+price_hub = PriceHub(PRICE_STREAM_MAX_SUBSCRIBERS)
+quote_cache.subscribe(price_hub.publish)
+
+
+def events(subscription, heartbeat=PRICE_STREAM_HEARTBEAT):
+    """Yield a subscription's updates as Server-Sent Events until the client goes away"""
+    try:
+        # Ask the browser to wait a few seconds before reconnecting after a dropped connection
+        yield "retry: 5000\n\n"
+        while True:
+            # Keep the refresher fetching these symbols while someone watches them
+            hot_symbols.touch(subscription.symbols)
+            updates = subscription.wait(heartbeat)
+            if not updates:
+                yield ": heartbeat\n\n"
+            for update in updates:
+                yield f"event: price\ndata: {json.dumps(update)}\n\n"
+    finally:
+        price_hub.unsubscribe(subscription)
@@ -0,0 +1,138 @@
+"""Asyncio HTTP client for the quote and exchange rate APIs
+
+Every upstream call of a worker process runs on one event loop in a
+background thread, over a bounded pool of keep-alive connections. Request
+threads use the blocking facade (get, get_many), which hands requests to
+the loop and waits for them, so a whole portfolio is priced in one pass
+over the loop instead of one blocking call per symbol.
+"""
+
+import asyncio
+import atexit
+import os
+import threading
+
+from collections import namedtuple
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import aiohttp
+
+
+UpstreamResponse = namedtuple("UpstreamResponse", ["status", "body"])
+
+
+class UpstreamError(Exception):
+    """Raised when an upstream request gets no response (connection error or deadline)"""
+
+
+class AsyncHttpClient:
+    """Pooled asyncio HTTP client with a blocking facade
+
+    At most concurrency requests are in flight at once and at most
+    connections sockets are kept open (connections_per_host per host), each
+    reused for keepalive seconds. The loop thread, session and pool are only
+    created on first use, i.e. inside the worker process.
+    """
+
+    def __init__(self, connections, connections_per_host, keepalive, concurrency, headers=None):
+        self.connections = connections
+        self.connections_per_host = connections_per_host
+        self.keepalive = keepalive
+        self.concurrency = concurrency
+        self.headers = headers or {}
+        self._forget()
+        # The loop thread does not survive fork(); a child starts its own
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="quote-client", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _ensure_session(self):
+        # Only ever called on the loop thread, so no locking is needed
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.connections, limit_per_host=self.connections_per_host,
+                                             keepalive_timeout=self.keepalive, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def _request(self, url):
+        session = self._ensure_session()
+        async with self._semaphore:
+            async with session.get(url) as response:
+                return UpstreamResponse(response.status, await response.read())
+
+    async def _get(self, url, timeout):
+        # The deadline covers waiting for a free slot as well as the request itself
+        try:
+            return await asyncio.wait_for(self._request(url), timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise UpstreamError(f"GET {url} failed: {e!r}") from e
+
+    async def _get_many(self, urls, timeout):
+        return await asyncio.gather(*(self._get(url, timeout) for url in urls), return_exceptions=True)
+
+    def get_many(self, urls, timeout):
+        """Fetch several URLs concurrently, each with a deadline of timeout seconds
+
+        Returns an UpstreamResponse or UpstreamError per URL, in order.
+        """
+        urls = list(urls)
+        if not urls:
+            return []
+        future = asyncio.run_coroutine_threadsafe(self._get_many(urls, timeout), self._ensure_loop())
+        try:
+            # Every request has its own deadline; this only guards against a stuck loop
+            results = future.result(timeout * 2)
+        except FutureTimeoutError:
+            future.cancel()
+            return [UpstreamError("deadline exceeded") for _ in urls]
+        return [result if isinstance(result, (UpstreamResponse, UpstreamError)) else UpstreamError(repr(result))
+                for result in results]
+
+    def get(self, url, timeout):
+        """Fetch one URL, raising UpstreamError if no response arrives within timeout seconds"""
+        result = self.get_many([url], timeout)[0]
+        if isinstance(result, UpstreamError):
+            raise result
+        return result
+
+    def warm_up(self):
+        """Start the loop thread ahead of the first request"""
+        self._ensure_loop()
+
+    def close(self):
+        """Close pooled connections and stop the loop thread"""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+
+        async def shutdown():
+            if self._session is not None:
+                await self._session.close()
+                self._session = None
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), loop).result(5)
+        except (FutureTimeoutError, RuntimeError):
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def create_client(connections, connections_per_host, keepalive, concurrency, headers=None):
+    """Create a client that is closed when the process exits"""
+    client = AsyncHttpClient(connections, connections_per_host, keepalive, concurrency, headers)
+    atexit.register(client.close)
+    return client
@@ -0,0 +1,644 @@
+import datetime
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+import pytz
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from charts import PriceSeries
+from metrics import count_upstream, span
+from quote_client import UpstreamError, create_client
+from symbols import known_symbol
+
+
+load_dotenv()
+api_key = os.getenv("API_KEY")
+
+# Upstream endpoints (overridable so benchmarks can point them at local stand-ins)
+YAHOO_CHART_URL = os.getenv("YAHOO_CHART_URL", "https://query2.finance.yahoo.com/v8/finance/chart")
+FX_API_URL = os.getenv("FX_API_URL", "https://v6.exchangerate-api.com/v6")
+
+# Seconds a cached quote is served before it is fetched again
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "60"))
+# Maximum number of symbols kept in the cache
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "1024"))
+# Tighter freshness window used when pricing a trade
+TRADE_QUOTE_MAX_AGE = float(os.getenv("TRADE_QUOTE_MAX_AGE", "5"))
+# Seconds between USD/INR exchange rate refreshes
+FX_REFRESH_INTERVAL = float(os.getenv("FX_REFRESH_INTERVAL", "3600"))
+# Seconds to wait before retrying a failed exchange rate refresh
+FX_RETRY_INTERVAL = float(os.getenv("FX_RETRY_INTERVAL", "60"))
+# Worker threads used to revalidate stale quotes in the background
+QUOTE_WORKERS = int(os.getenv("QUOTE_WORKERS", "8"))
+# Upstream requests in flight at once, and pooled keep-alive connections (in total and per host)
+QUOTE_CONCURRENCY = int(os.getenv("QUOTE_CONCURRENCY", "32"))
+QUOTE_CONNECTIONS = int(os.getenv("QUOTE_CONNECTIONS", "32"))
+QUOTE_CONNECTIONS_PER_HOST = int(os.getenv("QUOTE_CONNECTIONS_PER_HOST", "16"))
+# Seconds an idle upstream connection is kept open for reuse
+QUOTE_KEEPALIVE = float(os.getenv("QUOTE_KEEPALIVE", "30"))
+# Seconds before a single upstream request is abandoned, per host
+QUOTE_REQUEST_TIMEOUT = float(os.getenv("QUOTE_REQUEST_TIMEOUT", "5"))
+YAHOO_REQUEST_TIMEOUT = float(os.getenv("YAHOO_REQUEST_TIMEOUT", str(QUOTE_REQUEST_TIMEOUT)))
+FX_REQUEST_TIMEOUT = float(os.getenv("FX_REQUEST_TIMEOUT", str(QUOTE_REQUEST_TIMEOUT)))
+# Oldest cached quote that may still be shown (flagged as stale) while the upstream is failing
+QUOTE_STALE_MAX_AGE = float(os.getenv("QUOTE_STALE_MAX_AGE", "3600"))
+# Consecutive upstream failures that open a host's circuit breaker
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+# Seconds an open circuit breaker waits before letting a trial request through
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+# Seconds a symbol stays "hot" (kept fresh in the background) after it was last looked up
+HOT_SYMBOL_TTL = float(os.getenv("HOT_SYMBOL_TTL", "900"))
+# Maximum number of hot symbols
+HOT_SYMBOLS_MAX = int(os.getenv("HOT_SYMBOLS_MAX", "500"))
+# Seconds a symbol Yahoo did not recognise is rejected without asking again
+INVALID_SYMBOL_TTL = float(os.getenv("INVALID_SYMBOL_TTL", "86400"))
+# Maximum number of remembered invalid symbols
+INVALID_SYMBOLS_MAX = int(os.getenv("INVALID_SYMBOLS_MAX", "10000"))
+
+
+quote_client = create_client(QUOTE_CONNECTIONS, QUOTE_CONNECTIONS_PER_HOST, QUOTE_KEEPALIVE, QUOTE_CONCURRENCY, headers={
+    "Accept": "*/*",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+})
+
+quote_pool = ThreadPoolExecutor(max_workers=QUOTE_WORKERS, thread_name_prefix="quote")
+
+
+def _new_quote_pool():
+    # Threads do not survive fork(), so a child needs a pool of its own
+    global quote_pool
+    quote_pool = ThreadPoolExecutor(max_workers=QUOTE_WORKERS, thread_name_prefix="quote")
+
+
+os.register_at_fork(after_in_child=_new_quote_pool)
+
+
+class QuoteCache:
+    """Process-wide LRU cache of quotes keyed by symbol, with a time-to-live"""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._entries = OrderedDict() # symbol -> (fetched_at, quote)
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, listener):
+        """Call listener(symbol, quote) with every quote stored from now on"""
+        self._listeners.append(listener)
+
+    def get(self, symbol, max_age=None):
+        """Return the cached quote for symbol if it is younger than max_age (defaults to the TTL)"""
+        max_age = self.ttl if max_age is None else min(max_age, self.ttl)
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is None or time.monotonic() - entry[0] > max_age:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(symbol)
+            self.hits += 1
+            return dict(entry[1])
+
+    def get_stale(self, symbol, max_age):
+        """Return (quote, age) for a cached quote past its TTL but younger than max_age, or None"""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is None:
+                return None
+            age = time.monotonic() - entry[0]
+            if age > max_age:
+                return None
+            self.stale_hits += 1
+            return dict(entry[1]), age
+
+    def put(self, symbol, quote):
+        """Store a freshly fetched quote, evicting the least recently used symbol when full"""
+        with self._lock:
+            self._entries[symbol] = (time.monotonic(), dict(quote))
+            self._entries.move_to_end(symbol)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        for listener in self._listeners:
+            listener(symbol, dict(quote))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Snapshot of the cache counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "stale_hits": self.stale_hits,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl
+            }
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stop calling an upstream host after repeated failures
+
+    After failure_threshold consecutive failures the breaker opens and calls
+    are refused for reset_timeout seconds. Then a single trial call is let
+    through: success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        """Return whether a call may be made now"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            # A failed trial reopens the breaker; otherwise open once the threshold is hit
+            if self._trial_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.trips += 1
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def is_open(self):
+        return self.state != "closed"
+
+
+yahoo_breaker = CircuitBreaker("yahoo", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+fx_breaker = CircuitBreaker("fx", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+
+
+class FxRateProvider:
+    """USD/INR exchange rate shared by all quotes, refreshed at most once per interval
+
+    If a refresh fails the last good rate keeps being served, and the next
+    attempt is delayed by retry_interval so an outage does not burn API quota.
+    """
+
+    def __init__(self, refresh_interval, retry_interval):
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.rate = None
+        self.fetched_at = None
+        self.refreshes = 0
+        self.failures = 0
+        self._next_attempt = 0.0
+        self._lock = threading.Lock()
+
+    def _fetch(self):
+        if not fx_breaker.allow():
+            count_upstream("fx", "short_circuit")
+            raise CircuitOpen("fx")
+        try:
+            response = quote_client.get(f"{FX_API_URL}/{api_key}/pair/USD/INR", FX_REQUEST_TIMEOUT)
+            if response.status >= 400:
+                raise UpstreamError(f"exchange rate API answered {response.status}")
+            rate = float(json.loads(response.body)["conversion_rate"])
+        except Exception:
+            fx_breaker.record_failure()
+            count_upstream("fx", "error")
+            raise
+        fx_breaker.record_success()
+        count_upstream("fx", "ok")
+        return rate
+
+    def get_rate(self):
+        """Return the current rate, refreshing it if the interval has passed (None if never fetched)"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_attempt:
+                return self.rate
+            try:
+                self.rate = self._fetch()
+                self.fetched_at = now
+                self.refreshes += 1
+                self._next_attempt = now + self.refresh_interval
+            except (CircuitOpen, KeyError, UpstreamError, TypeError, ValueError):
+                # Keep serving the last good rate
+                self.failures += 1
+                self._next_attempt = now + self.retry_interval
+            return self.rate
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "age": (time.monotonic() - self.fetched_at) if self.fetched_at is not None else None,
+                "refreshes": self.refreshes,
+                "failures": self.failures
+            }
+
+
+class HotSymbols:
+    """Symbols that were recently viewed or are held by active users
+
+    Every successful lookup marks its symbol; symbols not looked up for ttl
+    seconds drop out, and the least recently used go first when full.
+    """
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen = OrderedDict() # symbol -> last looked up
+        self._lock = threading.Lock()
+
+    def touch(self, symbols):
+        now = time.monotonic()
+        with self._lock:
+            for symbol in symbols:
+                self._seen[symbol] = now
+                self._seen.move_to_end(symbol)
+            while len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+
+    def active(self):
+        """Return the symbols that are still hot"""
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            while self._seen and next(iter(self._seen.values())) < cutoff:
+                self._seen.popitem(last=False)
+            return list(self._seen)
+
+
+class InvalidSymbols:
+    """Negative cache of symbols Yahoo did not recognise, so typos cost no upstream call"""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self._seen = OrderedDict() # symbol -> rejected at
+        self._lock = threading.Lock()
+
+    def add(self, symbol):
+        with self._lock:
+            self._seen[symbol] = time.monotonic()
+            self._seen.move_to_end(symbol)
+            while len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+
+    def __contains__(self, symbol):
+        with self._lock:
+            rejected_at = self._seen.get(symbol)
+            if rejected_at is None:
+                return False
+            if time.monotonic() - rejected_at > self.ttl:
+                del self._seen[symbol]
+                return False
+            self.hits += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "size": len(self._seen)}
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into a single call
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait for its result instead of making their own call.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {} # key -> (done event, [result])
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is None:
+                call = self._in_flight[key] = (threading.Event(), [None])
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        done, result = call
+        if not leader:
+            # A stuck leader only delays its followers up to the timeout
+            done.wait(self.timeout)
+            return result[0]
+
+        try:
+            result[0] = fn(*args)
+            return result[0]
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            done.set()
+
+    def do_many(self, keys, fn):
+        """Like do() for several keys at once
+
+        fn is called once with the keys nobody else is fetching and returns a
+        dict of key -> result; keys already in flight are waited on.
+        """
+        led = []
+        followed = []
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                call = self._in_flight.get(key)
+                if call is None:
+                    call = self._in_flight[key] = (threading.Event(), [None])
+                    self.calls += 1
+                    led.append((key, call))
+                else:
+                    self.coalesced += 1
+                    followed.append((key, call))
+
+        results = {}
+        try:
+            if led:
+                results.update(fn([key for key, call in led]))
+        finally:
+            with self._lock:
+                for key, (done, result) in led:
+                    result[0] = results.get(key)
+                    del self._in_flight[key]
+            for key, (done, result) in led:
+                done.set()
+
+        deadline = time.monotonic() + self.timeout
+        for key, (done, result) in followed:
+            done.wait(max(0.0, deadline - time.monotonic()))
+            results[key] = result[0]
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._in_flight)}
+
+
+quote_cache = QuoteCache(QUOTE_CACHE_TTL, QUOTE_CACHE_SIZE)
+quote_flights = SingleFlight(QUOTE_REQUEST_TIMEOUT * 2)
+hot_symbols = HotSymbols(HOT_SYMBOL_TTL, HOT_SYMBOLS_MAX)
+invalid_symbols = InvalidSymbols(INVALID_SYMBOL_TTL, INVALID_SYMBOLS_MAX)
+fx_rates = FxRateProvider(FX_REFRESH_INTERVAL, FX_RETRY_INTERVAL)
+
+
+def chart_url(symbol):
+    """Yahoo Finance chart URL with the last 7 days of daily prices for symbol"""
+    end = datetime.datetime.now(pytz.timezone("US/Eastern"))
+    start = end - datetime.timedelta(days=7)
+    return (
+        f"{YAHOO_CHART_URL}/{urllib.parse.quote_plus(symbol)}"
+        f"?period1={int(start.timestamp())}"
+        f"&period2={int(end.timestamp())}"
+        f"&interval=1d&events=history&includeAdjustedClose=true"
+    )
+
+
+def _chart_not_found(body):
+    """Return whether a chart response body is Yahoo's error for an unknown symbol"""
+    try:
+        error = json.loads(body)["chart"]["error"]
+    except (KeyError, TypeError, ValueError):
+        return False
+    return isinstance(error, dict) and error.get("code") == "Not Found"
+
+
+def _parse_quote(symbol, response):
+    """Turn a chart response (or UpstreamError) into a quote, keeping the breaker up to date
+
+    Only a 404 or Yahoo's "Not Found" chart error marks the symbol invalid;
+    any other error or unreadable answer counts against the breaker instead,
+    so an auth or format change upstream never hides held symbols for a day.
+    """
+    if not isinstance(response, UpstreamError):
+        if response.status == 404 or _chart_not_found(response.body):
+            # Yahoo is up and the symbol does not exist
+            yahoo_breaker.record_success()
+            count_upstream("yahoo", "invalid")
+            invalid_symbols.add(symbol)
+            return None
+        if response.status < 400:
+            try:
+                result = json.loads(response.body)["chart"]["result"][0]
+                price = float(result["meta"]["regularMarketPrice"])
+            except (KeyError, IndexError, TypeError, ValueError):
+                pass
+            else:
+                yahoo_breaker.record_success()
+                count_upstream("yahoo", "ok")
+                # Keep the daily closes that came with the quote for charts and analytics
+                return {"usd_price": price, "symbol": symbol, "series": PriceSeries.from_chart(result)}
+    yahoo_breaker.record_failure()
+    count_upstream("yahoo", "error")
+    return None
+
+
+def rejected_symbol(symbol):
+    """Return whether symbol is known to be invalid without asking Yahoo"""
+    return symbol in invalid_symbols or not known_symbol(symbol)
+
+
+def fetch_quotes(symbols):
+    """Fetch USD quotes for several symbols straight from Yahoo Finance in one pass, bypassing the cache
+
+    Returns a dict of symbol -> quote, with None for symbols that failed.
+    """
+    quotes = {}
+    allowed = []
+    for symbol in symbols:
+        if rejected_symbol(symbol):
+            quotes[symbol] = None
+        # Skip the call entirely while Yahoo is known to be failing
+        elif yahoo_breaker.allow():
+            allowed.append(symbol)
+        else:
+            count_upstream("yahoo", "short_circuit")
+            quotes[symbol] = None
+
+    responses = quote_client.get_many([chart_url(symbol) for symbol in allowed], YAHOO_REQUEST_TIMEOUT)
+    for symbol, response in zip(allowed, responses):
+        quotes[symbol] = _parse_quote(symbol, response)
+    return quotes
+
+
+def fetch_quote(symbol):
+    """Fetch the USD quote for symbol straight from Yahoo Finance, bypassing the cache"""
+    return fetch_quotes([symbol])[symbol]
+
+
+def _fetch_and_cache(symbol):
+    quote = fetch_quote(symbol)
+    if quote is not None:
+        quote_cache.put(symbol, quote)
+    return quote
+
+
+def _fetch_and_cache_many(symbols):
+    quotes = fetch_quotes(symbols)
+    for symbol, quote in quotes.items():
+        if quote is not None:
+            quote_cache.put(symbol, quote)
+    return quotes
+
+
+def refresh_quote(symbol):
+    """Fetch symbol into the cache, sharing one upstream call between concurrent callers"""
+    return quote_flights.do(symbol, _fetch_and_cache, symbol)
+
+
+def refresh_quotes(symbols):
+    """Fetch several symbols into the cache in one pass, waiting on any already being fetched
+
+    Returns a dict of symbol -> quote, with None for symbols that failed.
+    """
+    return quote_flights.do_many(symbols, _fetch_and_cache_many)
+
+
+def revalidate(symbol):
+    """Refresh symbol in the background, without waiting for the result"""
+    quote_pool.submit(refresh_quote, symbol)
+
+
+def quotes_unavailable():
+    """Return whether quotes cannot currently be fetched from Yahoo or converted to INR"""
+    # The last good exchange rate keeps being served while its API fails, so only a missing one counts
+    return yahoo_breaker.is_open() or fx_rates.get_rate() is None
+
+
+def to_inr(quote, fx_rate, stale_age=None):
+    """Convert a cached USD quote into the INR quote shown to users
+
+    Quotes served past their TTL are flagged with "stale" and their age in seconds.
+    """
+    series = quote.get("series")
+    inr_quote = {"price": quote["usd_price"] * fx_rate, "usd_price": quote["usd_price"], "symbol": quote["symbol"],
+                 "series": series.scaled(fx_rate) if series is not None else None, "stale": stale_age is not None}
+    if stale_age is not None:
+        inr_quote["age"] = stale_age
+    return inr_quote
+
+
+def lookup(symbol, max_age=None, fx_rate=None, allow_stale=True):
+    """Look up quote for symbol
+
+    Quotes are served from the shared cache while they are fresh. Pass max_age
+    (in seconds) to demand a fresher price than the cache TTL, e.g. for trades.
+    Pass fx_rate to price several quotes against one exchange rate snapshot.
+
+    Unless allow_stale is False, an expired quote up to QUOTE_STALE_MAX_AGE old
+    is served (flagged as stale) and refreshed in the background, and is also
+    the fallback when the upstream fails.
+    """
+
+    symbol = symbol.upper()
+    if rejected_symbol(symbol):
+        return None
+    if fx_rate is None:
+        with span("fx"):
+            fx_rate = fx_rates.get_rate()
+        if fx_rate is None:
+            return None
+
+    quote = quote_cache.get(symbol, max_age)
+    if quote is not None:
+        hot_symbols.touch([symbol])
+        return to_inr(quote, fx_rate)
+
+    stale = quote_cache.get_stale(symbol, QUOTE_STALE_MAX_AGE) if allow_stale else None
+    if stale is not None:
+        revalidate(symbol)
+        hot_symbols.touch([symbol])
+        return to_inr(stale[0], fx_rate, stale_age=stale[1])
+
+    with span("quote"):
+        quote = refresh_quote(symbol)
+    if quote is None:
+        return None
+    hot_symbols.touch([symbol])
+    return to_inr(quote, fx_rate)
+
+
+def lookup_many(symbols, max_age=None, fx_rate=None, allow_stale=True):
+    """Look up quotes for several symbols at once
+
+    Cached symbols are answered directly (stale ones as in lookup) and the rest
+    are fetched concurrently in one pass of the quote client. Returns a dict of
+    symbol -> quote; symbols whose lookup failed or timed out are left out, so
+    callers get partial results.
+    """
+
+    symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+    if fx_rate is None:
+        with span("fx"):
+            fx_rate = fx_rates.get_rate()
+    if fx_rate is None or not symbols:
+        return {}
+
+    quotes = {}
+    missing = []
+    for symbol in symbols:
+        quote = quote_cache.get(symbol, max_age)
+        if quote is not None:
+            quotes[symbol] = to_inr(quote, fx_rate)
+            continue
+        stale = quote_cache.get_stale(symbol, QUOTE_STALE_MAX_AGE) if allow_stale else None
+        if stale is not None:
+            revalidate(symbol)
+            quotes[symbol] = to_inr(stale[0], fx_rate, stale_age=stale[1])
+        else:
+            missing.append(symbol)
+
+    if not missing:
+        hot_symbols.touch(quotes)
+        return quotes
+
+    with span("quote"):
+        fetched = refresh_quotes(missing)
+    for symbol, quote in fetched.items():
+        if quote is not None:
+            quotes[symbol] = to_inr(quote, fx_rate)
+    hot_symbols.touch(quotes)
+    return quotes
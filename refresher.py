@@ -0,0 +1,89 @@
+"""Background refresh of hot symbols so page views are served from the cache"""
+
+import atexit
+import os
+import threading
+
+from quotes import QUOTE_CACHE_TTL, fx_rates, hot_symbols, refresh_quotes
+
+
+# Set to 0 to disable the background refresher
+PRICE_REFRESH_ENABLED = os.getenv("PRICE_REFRESH_ENABLED", "1") == "1"
+# Seconds between refreshes of the hot symbols (keep it below the cache TTL)
+PRICE_REFRESH_INTERVAL = float(os.getenv("PRICE_REFRESH_INTERVAL", str(QUOTE_CACHE_TTL / 2)))
+# Longest wait between refreshes while the upstream keeps failing
+PRICE_REFRESH_MAX_BACKOFF = float(os.getenv("PRICE_REFRESH_MAX_BACKOFF", "300"))
+
+
+class PriceRefresher:
+    """Keep the quotes of hot symbols fresh in the shared quote cache
+
+    Runs one daemon thread per worker process. When most refreshes in a round
+    fail, the delay before the next round doubles (up to max_backoff) and is
+    reset by the next healthy round.
+    """
+
+    def __init__(self, interval, max_backoff):
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.delay = interval
+        self.rounds = 0
+        self.refreshed = 0
+        self.failed = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the refresher thread if it is not already running"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="price-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stop the refresher and wait for the current round to finish"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.delay):
+            self.refresh_once()
+
+    def refresh_once(self):
+        """Refresh the exchange rate and every hot symbol once"""
+        fx_rates.get_rate()
+        symbols = hot_symbols.active()
+        # One pass of the quote client, which bounds how many requests run at once
+        quotes = refresh_quotes(symbols)
+        failures = sum(1 for symbol in symbols if quotes.get(symbol) is None)
+
+        self.rounds += 1
+        self.refreshed += len(symbols) - failures
+        self.failed += failures
+        if symbols and failures * 2 > len(symbols):
+            # Back off while the upstream is unhealthy
+            self.delay = min(self.delay * 2, self.max_backoff)
+        else:
+            self.delay = self.interval
+
+    def stats(self):
+        return {"rounds": self.rounds, "refreshed": self.refreshed, "failed": self.failed, "delay": self.delay}
+
+
+price_refresher = PriceRefresher(PRICE_REFRESH_INTERVAL, PRICE_REFRESH_MAX_BACKOFF)
+atexit.register(price_refresher.stop)
+
+
+def init_app(app):
+    """Start the refresher with the first request, i.e. inside the worker process"""
+    if not PRICE_REFRESH_ENABLED:
+        return
+
+    @app.before_request
+    def start_price_refresher():
+        price_refresher.start()
@@ -0,0 +1,204 @@
+"""Resting limit and stop orders, evaluated in batches per symbol
+
+Open orders are kept in an in-memory book, indexed by symbol and sorted by
+trigger price, and loaded again from storage every ORDER_BOOK_RELOAD
+seconds to pick up orders placed through other workers. Each evaluation
+round prices every symbol in the book with one batch of quotes; the orders
+a price triggers are then found by bisection, so a round costs one price
+and O(log n) comparisons per symbol plus the work of the fills themselves.
+
+Triggered orders are filled at the current price through the same
+transaction as market trades. Filling checks the order is still open,
+so several evaluators never fill one twice, but each one prices every
+symbol in the book every round, so one process should evaluate: either
+`flask evaluate-orders` next to the web server, or a single-process
+server with ORDER_EVALUATION_ENABLED=1.
+"""
+
+import atexit
+import bisect
+import os
+import threading
+import time
+
+from portfolio import portfolio_cache
+from quotes import TRADE_QUOTE_MAX_AGE, lookup_many
+
+
+# Set to 1 to fill resting orders in the web server process itself (only when it runs a single worker)
+ORDER_EVALUATION_ENABLED = os.getenv("ORDER_EVALUATION_ENABLED", "0") == "1"
+# Seconds between evaluation rounds
+ORDER_EVALUATION_INTERVAL = float(os.getenv("ORDER_EVALUATION_INTERVAL", "5"))
+# Seconds between reloads of the open orders from storage
+ORDER_BOOK_RELOAD = float(os.getenv("ORDER_BOOK_RELOAD", "60"))
+
+
+def rises_to_trigger(order):
+    """Return whether an order triggers when the price rises to it (sell limits, buy stops) or falls to it"""
+    return (order["side"] == "sell") == (order["type"] == "limit")
+
+
+class OrderBook:
+    """Open orders by symbol, each side of the trigger sorted by price
+
+    Per symbol, orders that trigger at or above their price (sell limits,
+    buy stops) and at or below it (buy limits, sell stops) are kept in
+    separate ascending lists of trigger prices, with the order IDs in
+    matching positions.
+    """
+
+    def __init__(self):
+        self._orders = {} # order ID -> order
+        self._rising = {} # symbol -> ([trigger prices], [order IDs])
+        self._falling = {}
+        self._lock = threading.Lock()
+
+    def _side(self, order):
+        return self._rising if rises_to_trigger(order) else self._falling
+
+    def _add(self, order):
+        # Called with the lock held
+        if order["id"] in self._orders:
+            return
+        self._orders[order["id"]] = order
+        prices, ids = self._side(order).setdefault(order["symbol"], ([], []))
+        at = bisect.bisect_right(prices, order["trigger_price"])
+        prices.insert(at, order["trigger_price"])
+        ids.insert(at, order["id"])
+
+    def add(self, order):
+        with self._lock:
+            self._add(order)
+
+    def remove(self, order_id):
+        with self._lock:
+            order = self._orders.pop(order_id, None)
+            if order is None:
+                return
+            side = self._side(order)
+            prices, ids = side[order["symbol"]]
+            # Look among the orders with the same trigger price only
+            at = bisect.bisect_left(prices, order["trigger_price"])
+            at += ids[at:].index(order_id)
+            del prices[at], ids[at]
+            if not ids:
+                del side[order["symbol"]]
+
+    def replace(self, orders):
+        """Replace the whole book, e.g. with the open orders loaded from storage"""
+        with self._lock:
+            self._orders.clear()
+            self._rising.clear()
+            self._falling.clear()
+            for order in orders:
+                self._add(order)
+
+    def symbols(self):
+        with self._lock:
+            return list(self._rising.keys() | self._falling.keys())
+
+    def triggered(self, symbol, price):
+        """Return the orders for symbol that a price of price triggers, oldest first"""
+        with self._lock:
+            prices, ids = self._rising.get(symbol, ((), ()))
+            order_ids = list(ids[:bisect.bisect_right(prices, price)])
+            prices, ids = self._falling.get(symbol, ((), ()))
+            order_ids += ids[bisect.bisect_left(prices, price):]
+            orders = [self._orders[order_id] for order_id in order_ids]
+        return sorted(orders, key=lambda order: order["created_at"])
+
+    def __len__(self):
+        return len(self._orders)
+
+
+class OrderEvaluator:
+    """Fill the resting orders in a book whose trigger prices are reached
+
+    Runs one daemon thread per worker process, like the price refresher.
+    """
+
+    def __init__(self, book, interval, reload_interval):
+        self.book = book
+        self.interval = interval
+        self.reload_interval = reload_interval
+        self.storage = None
+        self.rounds = 0
+        self.filled = 0
+        self.rejected = 0
+        self._loaded_at = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the evaluator thread if it is not already running"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="order-evaluator", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stop the evaluator and wait for the current round to finish"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def run(self):
+        """Evaluate rounds on the calling thread until stopped"""
+        self._stop.clear()
+        self._run()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.evaluate_once()
+            except Exception as e:
+                # Orders that were not filled stay in the book for the next round
+                print(f"WARNING: Order evaluation failed: {e!r}")
+
+    def evaluate_once(self):
+        """Price every symbol with open orders once and fill the orders triggered"""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.reload_interval:
+            self.book.replace(list(self.storage.open_orders()))
+            self._loaded_at = time.monotonic()
+
+        # One batch of fresh quotes for every symbol in the book
+        quotes = lookup_many(self.book.symbols(), max_age=TRADE_QUOTE_MAX_AGE, allow_stale=False)
+        for symbol, quote in quotes.items():
+            for order in self.book.triggered(symbol, quote["price"]):
+                self.fill(order, quote["price"])
+        self.rounds += 1
+
+    def fill(self, order, price):
+        try:
+            self.storage.fill_order(order["user_id"], order["id"], price)
+            self.filled += 1
+        except ValueError as e:
+            if str(e) != "Order is not open":
+                # e.g. not enough cash left when the price was reached
+                self.storage.reject_order(order["user_id"], order["id"], str(e))
+                self.rejected += 1
+        portfolio_cache.invalidate(order["user_id"])
+        self.book.remove(order["id"])
+
+    def stats(self):
+        return {"rounds": self.rounds, "filled": self.filled, "rejected": self.rejected, "open": len(self.book)}
+
+
+order_book = OrderBook()
+order_evaluator = OrderEvaluator(order_book, ORDER_EVALUATION_INTERVAL, ORDER_BOOK_RELOAD)
+atexit.register(order_evaluator.stop)
+
+
+def init_app(app, storage):
+    """Fill resting orders from storage, if enabled, starting with the first request, i.e. inside the worker process"""
+    order_evaluator.storage = storage
+    if not ORDER_EVALUATION_ENABLED:
+        return
+
+    @app.before_request
+    def start_order_evaluator():
+        order_evaluator.start()
@@ -0,0 +1,26 @@
+// Suggest symbols from /symbols while typing in inputs marked with data-autocomplete
+document.querySelectorAll("input[data-autocomplete]").forEach(function (input) {
+    let list = document.getElementById(input.getAttribute("list"));
+    let timer = null;
+    input.addEventListener("input", function () {
+        clearTimeout(timer);
+        timer = setTimeout(async function () {
+            let query = input.value.trim();
+            if (!query) {
+                list.replaceChildren();
+                return;
+            }
+            let response = await fetch("/symbols?q=" + encodeURIComponent(query));
+            if (!response.ok) {
+                return;
+            }
+            let options = (await response.json()).map(function (match) {
+                let option = document.createElement("option");
+                option.value = match.symbol;
+                option.label = match.name;
+                return option;
+            });
+            list.replaceChildren(...options);
+        }, 150);
+    });
+});
@@ -0,0 +1,46 @@
+// Update the portfolio in place as live prices arrive from /prices/stream
+(function () {
+    let summary = document.getElementById("portfolio-summary");
+    let balance = parseFloat(summary.dataset.balance);
+    let deposit = parseFloat(summary.dataset.deposit);
+    let withdraw = parseFloat(summary.dataset.withdraw);
+
+    // Same format as the inr filter
+    function inr(value) {
+        return "₹" + value.toLocaleString("en-US", {minimumFractionDigits: 2, maximumFractionDigits: 2});
+    }
+
+    function updateTotals() {
+        let sum = 0;
+        document.querySelectorAll("tr[data-symbol]").forEach(function (row) {
+            let price = parseFloat(row.dataset.price);
+            if (!isNaN(price)) {
+                sum += price * parseInt(row.dataset.shares);
+            }
+        });
+        summary.querySelector("[data-field=sum]").textContent = inr(sum);
+        summary.querySelector("[data-field=grand-total]").textContent = inr(balance + sum);
+        summary.querySelector("[data-field=net-profit]").textContent = inr(balance + sum + withdraw - deposit);
+    }
+
+    let stream = new EventSource("/prices/stream");
+    stream.addEventListener("price", function (event) {
+        let update = JSON.parse(event.data);
+        let row = document.querySelector("tr[data-symbol='" + update.symbol + "']");
+        if (!row) {
+            return;
+        }
+        let shares = parseInt(row.dataset.shares);
+        let oldprice = parseFloat(row.dataset.oldprice);
+        row.dataset.price = update.price;
+        let priceCell = row.querySelector("[data-field=price]");
+        priceCell.querySelector("span").textContent = inr(update.price);
+        let badge = priceCell.querySelector(".badge");
+        if (badge && !update.stale) {
+            badge.remove();
+        }
+        row.querySelector("[data-field=total]").textContent = inr(update.price * shares);
+        row.querySelector("[data-field=gain]").textContent = inr((update.price - oldprice) * shares);
+        updateTotals();
+    });
+})();
@@ -0,0 +1,89 @@
+"""Storage backends for users, their transaction history and holdings
+
+The backend is chosen with STORAGE_BACKEND: "firestore" (the default) or
+"sqlite", which keeps everything in a local database file at SQLITE_PATH.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from storage.base import AccountChange, Storage
+from storage.unit_of_work import UnitOfWork
+
+
+load_dotenv()
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firestore")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "webquity.db")
+FIREBASE_CREDENTIALS = os.getenv("FIREBASE_CREDENTIALS", "firebase.json")
+
+# Errors raised when the database itself cannot be reached
+DATABASE_ERRORS = (sqlite3.Error,)
+try:
+    from google.api_core import exceptions as google_exceptions
+    DATABASE_ERRORS += (google_exceptions.GoogleAPICallError,)
+except ImportError:
+    pass
+
+
+def create_storage(backend=None):
+    """Create the configured storage backend"""
+    backend = backend or STORAGE_BACKEND
+    if backend == "firestore":
+        from storage.firestore_backend import FirestoreStorage
+        return FirestoreStorage(FIREBASE_CREDENTIALS)
+    elif backend == "sqlite":
+        from storage.sqlite_backend import SqliteStorage
+        return SqliteStorage(SQLITE_PATH)
+    raise ValueError(f"unknown storage backend: {backend}")
+
+
+class LazyStorage:
+    """Create the storage backend on first use, separately in every process
+
+    Database clients (Firestore's gRPC channels in particular) are not
+    fork-safe, so nothing is created at import time and a forked child
+    drops whatever its parent had created. The proxy is false while the
+    backend cannot be created; creating it is retried at most every
+    retry_interval seconds.
+    """
+
+    def __init__(self, factory, retry_interval=30):
+        self._factory = factory
+        self.retry_interval = retry_interval
+        self._forget()
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        self._target = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the backend, creating it if needed (None if that fails)"""
+        if self._target is not None:
+            return self._target
+        with self._lock:
+            if self._target is None and (self._failed_at is None
+                                         or time.monotonic() - self._failed_at >= self.retry_interval):
+                try:
+                    self._target = self._factory()
+                except Exception as e:
+                    print(f"FATAL: Failed to initialize {STORAGE_BACKEND} storage: {e}")
+                    self._failed_at = time.monotonic()
+            return self._target
+
+    def __bool__(self):
+        return self.get() is not None
+
+    def __getattr__(self, attr):
+        target = self.get()
+        if target is None:
+            raise RuntimeError("storage is unavailable")
+        return getattr(target, attr)
+
+
+__all__ = ["AccountChange", "DATABASE_ERRORS", "LazyStorage", "Storage", "UnitOfWork", "create_storage"]
@@ -0,0 +1,228 @@
+import datetime
+import math
+
+from collections import namedtuple
+
+from metrics import count_documents
+
+
+# History newer than this is never compacted: a trade still in flight may yet be recorded with an earlier time
+COMPACTION_MARGIN = datetime.timedelta(hours=1)
+
+
+# The user before and after a trade or cash operation, both as read and written in its transaction
+AccountChange = namedtuple("AccountChange", ["before", "after"])
+
+
+class Storage:
+    """Interface shared by the storage backends
+
+    User IDs are strings. Users are returned as dicts with their "id",
+    "username", "hash", "cash", "deposit" and "withdraw". The trade and cash
+    operations run atomically and raise ValueError with a readable message
+    when they are refused (e.g. "Insufficient balance").
+    """
+
+    name = None
+
+    def _reads(self, count=1):
+        """Count documents (or rows) read, for the metrics endpoint"""
+        count_documents(self.name, "read", count)
+
+    def _writes(self, count=1):
+        """Count documents (or rows) written, for the metrics endpoint"""
+        count_documents(self.name, "write", count)
+
+    # --- Users ---
+
+    def get_user(self, user_id):
+        """Return the user with this ID, or None"""
+        raise NotImplementedError
+
+    def get_user_by_username(self, username):
+        """Return the user with this username, or None"""
+        raise NotImplementedError
+
+    def create_user(self, username, password_hash):
+        """Create a user with no cash and return its ID; raise ValueError if the username is taken"""
+        raise NotImplementedError
+
+    def update_password_hash(self, user_id, password_hash):
+        raise NotImplementedError
+
+    def delete_user(self, user_id):
+        """Delete the user with its username, history, positions, orders and snapshots"""
+        raise NotImplementedError
+
+    # --- Holdings and history ---
+
+    def get_positions(self, user_id):
+        """Return the user's positions that still hold shares as dicts of symbol, shares and cost_basis"""
+        raise NotImplementedError
+
+    def history_page(self, user_id, page_size, after=None, before=None, symbol=None, type=None):
+        """Return (rows, has_prev, has_next) for one page of history, newest first
+
+        Pages are addressed by the row ID that precedes them (after) or follows
+        them (before). Rows are dicts with their "id", "symbol", "price",
+        "shares", "total", "type" and "time". Raise ValueError("Invalid page")
+        for an unknown cursor.
+        """
+        raise NotImplementedError
+
+    def iter_history(self, user_id, start=None, end=None, page_size=500):
+        """Yield the user's history rows oldest first, reading page_size rows at a time
+
+        Optional start and end datetimes limit the rows to start <= time < end.
+        Rows are dicts as returned by history_page.
+        """
+        raise NotImplementedError
+
+    # --- Transactions ---
+
+    def buy(self, user_id, symbol, price, shares):
+        """Record a purchase and return its AccountChange"""
+        raise NotImplementedError
+
+    def sell(self, user_id, symbol, price, shares):
+        """Record a sale and return its AccountChange"""
+        raise NotImplementedError
+
+    def trade(self, user_id, legs):
+        """Record several buys and sells as one transaction and return its AccountChange
+
+        legs are (symbol, price, shares) tuples, with negative shares for
+        sales. Cash and shares are checked for the order as a whole (sales
+        pay for purchases), and nothing is recorded if any leg is refused.
+        """
+        raise NotImplementedError
+
+    def deposit(self, user_id, amount):
+        """Add cash and return the AccountChange"""
+        raise NotImplementedError
+
+    def withdraw(self, user_id, amount):
+        """Remove cash and return the AccountChange"""
+        raise NotImplementedError
+
+    # --- Resting orders ---
+
+    def place_order(self, user_id, symbol, side, type, shares, trigger_price):
+        """Store an open limit or stop order and return it
+
+        Orders are dicts with their "id", "user_id", "symbol", "side" ("buy"
+        or "sell"), "type" ("limit" or "stop"), "shares", "trigger_price",
+        "status" ("open", "filled", "rejected" or "cancelled") and "created_at".
+        """
+        raise NotImplementedError
+
+    def get_orders(self, user_id):
+        """Return the user's open orders, oldest first"""
+        raise NotImplementedError
+
+    def open_orders(self):
+        """Yield the open orders of every user"""
+        raise NotImplementedError
+
+    def cancel_order(self, user_id, order_id):
+        """Cancel one of the user's open orders; raise ValueError("Order not found") if there is none"""
+        raise NotImplementedError
+
+    def fill_order(self, user_id, order_id, price):
+        """Execute an open order at price and return its AccountChange
+
+        The trade is checked and recorded exactly as by trade(), in the same
+        transaction that marks the order filled. Raises ValueError("Order is
+        not open") if it was filled or cancelled meanwhile, or the trade's
+        own ValueError, in which case the order stays open.
+        """
+        raise NotImplementedError
+
+    def reject_order(self, user_id, order_id, reason):
+        """Close an open order that cannot be filled, recording why"""
+        raise NotImplementedError
+
+    # --- History snapshots ---
+
+    def get_snapshots(self, user_id):
+        """Return (watermark, snapshots) for the user's compacted history
+
+        Snapshots are dicts of symbol, shares and cost_basis summing every
+        history row before the watermark (an aware datetime), one per symbol
+        traded before it. The watermark is None if nothing was compacted.
+        """
+        raise NotImplementedError
+
+    def save_snapshots(self, user_id, previous_watermark, watermark, snapshots):
+        """Replace the user's snapshots with ones summing the history before watermark
+
+        Raise ValueError("Snapshots changed meanwhile") unless the stored
+        watermark is still previous_watermark.
+        """
+        raise NotImplementedError
+
+    def user_ids(self):
+        """Yield the ID of every user"""
+        raise NotImplementedError
+
+    def compact_user_history(self, user_id, before):
+        """Fold the user's history rows older than before into their snapshots and return how many were folded"""
+        before = min(before, datetime.datetime.now(datetime.timezone.utc) - COMPACTION_MARGIN)
+        watermark, snapshots = self.get_snapshots(user_id)
+        if watermark is not None and watermark >= before:
+            return 0
+        totals = {snapshot["symbol"]: dict(snapshot) for snapshot in snapshots}
+        folded = 0
+        # Only the rows since the last compaction are read
+        for row in self.iter_history(user_id, start=watermark, end=before):
+            snapshot = totals.setdefault(row["symbol"], {"symbol": row["symbol"], "shares": 0, "cost_basis": 0.0})
+            snapshot["shares"] += row["shares"]
+            snapshot["cost_basis"] += row["total"]
+            folded += 1
+        if folded:
+            self.save_snapshots(user_id, watermark, before, list(totals.values()))
+        return folded
+
+    def compact_history(self, before):
+        """Fold every user's history older than before into snapshots, yielding (user ID, rows folded)"""
+        for user_id in list(self.user_ids()):
+            yield user_id, self.compact_user_history(user_id, before)
+
+    def verify_snapshots(self):
+        """Check every user's snapshots against a full scan of their history before the watermark
+
+        Yields (user ID, mismatches), where mismatches are dicts of symbol,
+        snapshot and history, the latter two (shares, cost_basis) tuples.
+        """
+        for user_id in list(self.user_ids()):
+            watermark, snapshots = self.get_snapshots(user_id)
+            if watermark is None:
+                yield user_id, []
+                continue
+            expected = {}
+            for row in self.iter_history(user_id, end=watermark):
+                shares, cost_basis = expected.get(row["symbol"], (0, 0.0))
+                expected[row["symbol"]] = (shares + row["shares"], cost_basis + row["total"])
+            found = {snapshot["symbol"]: (snapshot["shares"], snapshot["cost_basis"]) for snapshot in snapshots}
+            mismatches = []
+            for symbol in sorted(expected.keys() | found.keys()):
+                snapshot, history = found.get(symbol, (0, 0.0)), expected.get(symbol, (0, 0.0))
+                # Cost bases are float sums, added up in a different order than the scan's
+                if snapshot[0] != history[0] or not math.isclose(snapshot[1], history[1], rel_tol=1e-9, abs_tol=1e-6):
+                    mismatches.append({"symbol": symbol, "snapshot": snapshot, "history": history})
+            yield user_id, mismatches
+
+    # --- Maintenance ---
+
+    def backfill_positions(self):
+        """Rebuild every user's positions from their snapshots and later history, yielding (user ID, number of positions)"""
+        raise NotImplementedError
+
+    def backfill_usernames(self):
+        """Rebuild the username index and return (number of usernames indexed, duplicates)
+
+        Users whose username is already indexed for another user are left
+        out; duplicates lists them as (username, user ID left out, user ID
+        the username stays with).
+        """
+        raise NotImplementedError
@@ -0,0 +1,518 @@
+import os
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.api_core import exceptions as google_exceptions
+
+from storage.base import AccountChange, Storage
+
+
+class FirestoreStorage(Storage):
+    """Cloud Firestore backend
+
+    Layout: users/{id} with history/{auto-id}, positions/{symbol},
+    orders/{auto-id} and snapshots/{symbol} subcollections, plus
+    usernames/{username} -> {"user_id": id}.
+    """
+
+    name = "firestore"
+
+    def __init__(self, credentials_path):
+        # One Firebase app per process, so a forked worker never reuses its parent's channels
+        name = f"webquity-{os.getpid()}"
+        try:
+            firebase_app = firebase_admin.get_app(name)
+        except ValueError:
+            firebase_app = firebase_admin.initialize_app(credentials.Certificate(credentials_path), name=name)
+        self.client = firestore.client(firebase_app)
+
+    def _user_ref(self, user_id):
+        return self.client.collection("users").document(user_id)
+
+    @staticmethod
+    def _user_dict(snapshot):
+        user = snapshot.to_dict()
+        if user is None:
+            raise Exception("User data is unexpectedly None")
+        user["id"] = snapshot.id
+        return user
+
+    # --- Users ---
+
+    def get_user(self, user_id):
+        snapshot = self._user_ref(user_id).get()
+        self._reads()
+        return self._user_dict(snapshot) if snapshot.exists else None
+
+    def get_user_by_username(self, username):
+        # Look up the user ID in the username index, then the user itself
+        username_doc = self.client.collection("usernames").document(username).get()
+        self._reads()
+        if not username_doc.exists:
+            return None
+        return self.get_user(username_doc.get("user_id"))
+
+    def create_user(self, username, password_hash):
+        @firestore.transactional
+        def register_transaction(transaction, username_doc_ref, user_doc_ref, user_data):
+            # Ensure username does not already exist
+            if username_doc_ref.get(transaction=transaction).exists:
+                raise ValueError("Username already exists")
+            # Claim the username and insert the new user together
+            transaction.create(username_doc_ref, {"user_id": user_doc_ref.id})
+            transaction.set(user_doc_ref, user_data)
+
+        new_user_data = {
+            "username": username,
+            "hash": password_hash,
+            "cash": 0.0,
+            "deposit": 0.0,
+            "withdraw": 0.0,
+            "created_at": firestore.SERVER_TIMESTAMP
+        }
+        doc_ref = self.client.collection("users").document() # Auto-ID
+        try:
+            register_transaction(self.client.transaction(), self.client.collection("usernames").document(username),
+                                 doc_ref, new_user_data)
+        except google_exceptions.AlreadyExists:
+            # Another registration claimed the username first
+            raise ValueError("Username already exists")
+        self._reads()
+        self._writes(2)
+        return doc_ref.id
+
+    def update_password_hash(self, user_id, password_hash):
+        self._user_ref(user_id).update({"hash": password_hash})
+        self._writes()
+
+    def delete_user(self, user_id):
+        user_ref = self._user_ref(user_id)
+        snapshot = user_ref.get()
+        self._reads()
+        if not snapshot.exists:
+            return
+
+        # First, delete all documents in the 'history', 'positions', 'orders' and 'snapshots' subcollections
+        self._delete_collection(user_ref.collection("history"))
+        self._delete_collection(user_ref.collection("positions"))
+        self._delete_collection(user_ref.collection("orders"))
+        self._delete_collection(user_ref.collection("snapshots"))
+
+        # Then, delete the user document itself along with its username
+        batch = self.client.batch()
+        batch.delete(self.client.collection("usernames").document(snapshot.get("username")))
+        batch.delete(user_ref)
+        batch.commit()
+        self._writes(2)
+
+    def _delete_collection(self, coll_ref, batch_size=500):
+        """Delete every document in a collection, in batches"""
+        while True:
+            batch = self.client.batch()
+            doc_count_in_batch = 0
+            for doc_del in coll_ref.limit(batch_size).stream():
+                batch.delete(doc_del.reference)
+                doc_count_in_batch += 1
+
+            if doc_count_in_batch == 0: # No more documents to delete
+                break
+
+            batch.commit()
+            self._reads(doc_count_in_batch)
+            self._writes(doc_count_in_batch)
+
+            if doc_count_in_batch < batch_size: # Last batch was processed
+                break
+
+    # --- Holdings and history ---
+
+    def get_positions(self, user_id):
+        positions_ref = self._user_ref(user_id).collection("positions")
+        positions = [doc.to_dict() for doc in positions_ref.where(filter=firestore.FieldFilter("shares", ">", 0)).stream()]
+        self._reads(max(1, len(positions))) # Queries are billed at least one read
+        return positions
+
+    def history_page(self, user_id, page_size, after=None, before=None, symbol=None, type=None):
+        history_ref = self._user_ref(user_id).collection("history")
+
+        # Optional filters (each needs a composite index on the field and time)
+        history_query = history_ref
+        if symbol:
+            history_query = history_query.where(filter=firestore.FieldFilter("symbol", "==", symbol))
+        if type:
+            history_query = history_query.where(filter=firestore.FieldFilter("type", "==", type))
+        # Order by time, descending to show newest first
+        history_query = history_query.order_by("time", direction=firestore.Query.DESCENDING)
+
+        # Every page costs at most page size + 2 reads
+        if after:
+            cursor = history_ref.document(after).get()
+            if not cursor.exists:
+                raise ValueError("Invalid page")
+            history_docs = list(history_query.start_after(cursor).limit(page_size + 1).stream())
+            has_prev, has_next = True, len(history_docs) > page_size
+            history_docs = history_docs[:page_size]
+        elif before:
+            cursor = history_ref.document(before).get()
+            if not cursor.exists:
+                raise ValueError("Invalid page")
+            history_docs = list(history_query.end_before(cursor).limit_to_last(page_size + 1).get())
+            has_prev, has_next = len(history_docs) > page_size, True
+            history_docs = history_docs[-page_size:]
+        else:
+            history_docs = list(history_query.limit(page_size + 1).stream())
+            has_prev, has_next = False, len(history_docs) > page_size
+            history_docs = history_docs[:page_size]
+
+        self._reads(max(1, len(history_docs)) + (1 if after or before else 0))
+        rows = []
+        for doc in history_docs:
+            row = doc.to_dict()
+            row["id"] = doc.id
+            rows.append(row)
+        return rows, has_prev, has_next
+
+    def iter_history(self, user_id, start=None, end=None, page_size=500):
+        history_query = self._user_ref(user_id).collection("history")
+        if start is not None:
+            history_query = history_query.where(filter=firestore.FieldFilter("time", ">=", start))
+        if end is not None:
+            history_query = history_query.where(filter=firestore.FieldFilter("time", "<", end))
+        history_query = history_query.order_by("time")
+
+        last_doc = None
+        while True:
+            # Each page starts right after the last document of the previous one
+            page_query = history_query.start_after(last_doc) if last_doc else history_query
+            history_docs = list(page_query.limit(page_size).stream())
+            self._reads(max(1, len(history_docs)))
+            for doc in history_docs:
+                row = doc.to_dict()
+                row["id"] = doc.id
+                yield row
+            if len(history_docs) < page_size:
+                return
+            last_doc = history_docs[-1]
+
+    # --- Transactions ---
+
+    @staticmethod
+    def _apply_to_position(transaction, user_doc_ref, position_snapshot, symbol, shares, total):
+        """Add a trade's shares and total to the symbol's position inside a transaction"""
+        position = position_snapshot.to_dict() if position_snapshot.exists else {}
+        position_data = {
+            "symbol": symbol,
+            "shares": position.get("shares", 0) + shares,
+            "cost_basis": position.get("cost_basis", 0.0) + total,
+            "updated_at": firestore.SERVER_TIMESTAMP
+        }
+        transaction.set(user_doc_ref.collection("positions").document(symbol), position_data)
+
+    def buy(self, user_id, symbol, price, shares):
+        @firestore.transactional
+        def buy_transaction(transaction, user_doc_ref, purchase_cost, num_shares):
+            snapshot = user_doc_ref.get(transaction=transaction)
+            if not snapshot.exists: raise Exception("User not found during transaction")
+            position_snapshot = user_doc_ref.collection("positions").document(symbol).get(transaction=transaction)
+
+            user_data = self._user_dict(snapshot)
+            current_cash = float(user_data.get("cash", 0.0))
+            if current_cash < purchase_cost:
+                raise ValueError("Insufficient balance")
+
+            new_cash = current_cash - purchase_cost
+            transaction.update(user_doc_ref, {"cash": new_cash})
+
+            history_doc_ref = user_doc_ref.collection("history").document() # Auto-ID
+            transaction_data = {
+                "symbol": symbol, "price": price,
+                "shares": num_shares, "time": firestore.SERVER_TIMESTAMP,
+                "total": purchase_cost, "type": "buy"
+            }
+            transaction.set(history_doc_ref, transaction_data)
+            self._apply_to_position(transaction, user_doc_ref, position_snapshot, symbol, num_shares, purchase_cost)
+            return AccountChange(user_data, dict(user_data, cash=new_cash))
+
+        change = buy_transaction(self.client.transaction(), self._user_ref(user_id), price * shares, shares)
+        self._reads(2)
+        self._writes(3)
+        return change
+
+    def sell(self, user_id, symbol, price, shares):
+        @firestore.transactional
+        def sell_transaction(transaction, user_doc_ref, num_shares_to_sell, sale_proceeds):
+            # Check current holdings within the transaction
+            position_snapshot = user_doc_ref.collection("positions").document(symbol).get(transaction=transaction)
+            current_shares_owned = position_snapshot.to_dict().get("shares", 0) if position_snapshot.exists else 0
+
+            if current_shares_owned < num_shares_to_sell:
+                raise ValueError("Insufficient shares")
+
+            user_snapshot = user_doc_ref.get(transaction=transaction)
+            if not user_snapshot.exists: raise Exception("User not found during transaction")
+
+            user_data = self._user_dict(user_snapshot)
+            new_cash = float(user_data.get("cash", 0.0)) + sale_proceeds
+            transaction.update(user_doc_ref, {"cash": new_cash})
+
+            history_doc_ref = user_doc_ref.collection("history").document() # Auto-ID
+            transaction_data = {
+                "symbol": symbol, "price": price,
+                "shares": -num_shares_to_sell, # Negative for sell
+                "time": firestore.SERVER_TIMESTAMP,
+                "total": -sale_proceeds, # Negative total for sell
+                "type": "sell"
+            }
+            transaction.set(history_doc_ref, transaction_data)
+            self._apply_to_position(transaction, user_doc_ref, position_snapshot, symbol, -num_shares_to_sell, -sale_proceeds)
+            return AccountChange(user_data, dict(user_data, cash=new_cash))
+
+        change = sell_transaction(self.client.transaction(), self._user_ref(user_id), shares, price * shares)
+        self._reads(2)
+        self._writes(3)
+        return change
+
+    def _trade(self, transaction, user_doc_ref, legs):
+        """Check and record trade legs inside a transaction and return the AccountChange"""
+        symbols = list(dict.fromkeys(symbol for symbol, price, shares in legs))
+        snapshot = user_doc_ref.get(transaction=transaction)
+        if not snapshot.exists: raise Exception("User not found during transaction")
+        position_refs = [user_doc_ref.collection("positions").document(symbol) for symbol in symbols]
+        position_snapshots = {position.id: position for position in transaction.get_all(position_refs)}
+
+        # Net shares and total per symbol, as each position is written once
+        net = {symbol: [0, 0.0] for symbol in symbols}
+        for symbol, price, shares in legs:
+            net[symbol][0] += shares
+            net[symbol][1] += price * shares
+        for symbol, (shares, total) in net.items():
+            position = position_snapshots[symbol]
+            held = position.to_dict().get("shares", 0) if position.exists else 0
+            if held + shares < 0:
+                raise ValueError("Insufficient shares")
+
+        user_data = self._user_dict(snapshot)
+        new_cash = float(user_data.get("cash", 0.0)) - sum(total for shares, total in net.values())
+        if new_cash < 0:
+            raise ValueError("Insufficient balance")
+        transaction.update(user_doc_ref, {"cash": new_cash})
+
+        for symbol, price, shares in legs:
+            transaction.set(user_doc_ref.collection("history").document(), {
+                "symbol": symbol, "price": price,
+                "shares": shares, "time": firestore.SERVER_TIMESTAMP,
+                "total": price * shares, "type": "buy" if shares > 0 else "sell"
+            })
+        for symbol, (shares, total) in net.items():
+            self._apply_to_position(transaction, user_doc_ref, position_snapshots[symbol], symbol, shares, total)
+        return AccountChange(user_data, dict(user_data, cash=new_cash))
+
+    def trade(self, user_id, legs):
+        @firestore.transactional
+        def trade_transaction(transaction, user_doc_ref):
+            return self._trade(transaction, user_doc_ref, legs)
+
+        change = trade_transaction(self.client.transaction(), self._user_ref(user_id))
+        symbol_count = len(set(symbol for symbol, price, shares in legs))
+        self._reads(1 + symbol_count)
+        self._writes(1 + len(legs) + symbol_count)
+        return change
+
+    def deposit(self, user_id, amount):
+        @firestore.transactional
+        def deposit_cash_tx(transaction, user_doc_ref, amount_to_deposit):
+            snapshot = user_doc_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                raise Exception("User not found")
+            user_data = self._user_dict(snapshot)
+            new_cash = float(user_data.get("cash", 0.0)) + amount_to_deposit
+            new_deposit_total = float(user_data.get("deposit", 0.0)) + amount_to_deposit
+            transaction.update(user_doc_ref, {"cash": new_cash, "deposit": new_deposit_total})
+            return AccountChange(user_data, dict(user_data, cash=new_cash, deposit=new_deposit_total))
+
+        change = deposit_cash_tx(self.client.transaction(), self._user_ref(user_id), amount)
+        self._reads()
+        self._writes()
+        return change
+
+    def withdraw(self, user_id, amount):
+        @firestore.transactional
+        def withdraw_cash_tx(transaction, user_doc_ref, amount_to_withdraw):
+            snapshot = user_doc_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                raise Exception("User not found")
+
+            user_data = self._user_dict(snapshot)
+            current_cash = float(user_data.get("cash", 0.0))
+            if current_cash < amount_to_withdraw: # Double check within transaction
+                raise ValueError("Insufficient balance for withdrawal")
+
+            new_cash = current_cash - amount_to_withdraw
+            new_withdraw_total = float(user_data.get("withdraw", 0.0)) + amount_to_withdraw
+            transaction.update(user_doc_ref, {"cash": new_cash, "withdraw": new_withdraw_total})
+            return AccountChange(user_data, dict(user_data, cash=new_cash, withdraw=new_withdraw_total))
+
+        change = withdraw_cash_tx(self.client.transaction(), self._user_ref(user_id), amount)
+        self._reads()
+        self._writes()
+        return change
+
+    # --- Resting orders ---
+    # Orders live in users/{id}/orders/{auto-id}; open_orders() queries them as a
+    # collection group, which needs a collection group index on "status"
+
+    @staticmethod
+    def _order_dict(snapshot):
+        order = snapshot.to_dict()
+        order["id"] = snapshot.id
+        return order
+
+    def place_order(self, user_id, symbol, side, type, shares, trigger_price):
+        order = {"user_id": user_id, "symbol": symbol, "side": side, "type": type, "shares": shares,
+                 "trigger_price": trigger_price, "status": "open", "created_at": firestore.SERVER_TIMESTAMP}
+        order_ref = self._user_ref(user_id).collection("orders").document()
+        order_ref.set(order)
+        self._writes()
+        # Read back for the server timestamp
+        order = self._order_dict(order_ref.get())
+        self._reads()
+        return order
+
+    def get_orders(self, user_id):
+        orders_query = (self._user_ref(user_id).collection("orders")
+                        .where(filter=firestore.FieldFilter("status", "==", "open")))
+        orders = [self._order_dict(doc) for doc in orders_query.stream()]
+        self._reads(max(1, len(orders)))
+        return sorted(orders, key=lambda order: order["created_at"])
+
+    def open_orders(self, page_size=500):
+        orders_query = (self.client.collection_group("orders")
+                        .where(filter=firestore.FieldFilter("status", "==", "open")).order_by("__name__"))
+        last_doc = None
+        while True:
+            page_query = orders_query.start_after(last_doc) if last_doc else orders_query
+            order_docs = list(page_query.limit(page_size).stream())
+            self._reads(max(1, len(order_docs)))
+            for doc in order_docs:
+                yield self._order_dict(doc)
+            if len(order_docs) < page_size:
+                return
+            last_doc = order_docs[-1]
+
+    def _close_order(self, user_id, order_id, status, error, **fields):
+        @firestore.transactional
+        def close_transaction(transaction, order_ref):
+            snapshot = order_ref.get(transaction=transaction)
+            if not snapshot.exists or snapshot.to_dict().get("status") != "open":
+                raise ValueError(error)
+            transaction.update(order_ref, {"status": status, "closed_at": firestore.SERVER_TIMESTAMP, **fields})
+
+        close_transaction(self.client.transaction(), self._user_ref(user_id).collection("orders").document(order_id))
+        self._reads()
+        self._writes()
+
+    def cancel_order(self, user_id, order_id):
+        self._close_order(user_id, order_id, "cancelled", "Order not found")
+
+    def fill_order(self, user_id, order_id, price):
+        @firestore.transactional
+        def fill_transaction(transaction, user_doc_ref):
+            order_ref = user_doc_ref.collection("orders").document(order_id)
+            order_snapshot = order_ref.get(transaction=transaction)
+            order = order_snapshot.to_dict() if order_snapshot.exists else None
+            if order is None or order.get("status") != "open":
+                raise ValueError("Order is not open")
+            shares = order["shares"] if order["side"] == "buy" else -order["shares"]
+            change = self._trade(transaction, user_doc_ref, [(order["symbol"], price, shares)])
+            transaction.update(order_ref, {"status": "filled", "filled_price": price,
+                                           "closed_at": firestore.SERVER_TIMESTAMP})
+            return change
+
+        change = fill_transaction(self.client.transaction(), self._user_ref(user_id))
+        self._reads(3)
+        self._writes(4)
+        return change
+
+    def reject_order(self, user_id, order_id, reason):
+        try:
+            self._close_order(user_id, order_id, "rejected", "Order is not open", reason=reason)
+        except ValueError:
+            pass # Closed meanwhile
+
+    # --- History snapshots ---
+
+    @staticmethod
+    def _snapshots(snapshot_docs):
+        """Split snapshot documents into their watermark and snapshot dicts"""
+        snapshots = [doc.to_dict() for doc in snapshot_docs]
+        watermark = max((snapshot.pop("watermark") for snapshot in snapshots), default=None)
+        return watermark, snapshots
+
+    def get_snapshots(self, user_id):
+        snapshot_docs = list(self._user_ref(user_id).collection("snapshots").stream())
+        self._reads(max(1, len(snapshot_docs)))
+        return self._snapshots(snapshot_docs)
+
+    def save_snapshots(self, user_id, previous_watermark, watermark, snapshots):
+        @firestore.transactional
+        def save_transaction(transaction, snapshots_ref):
+            # Every snapshot is rewritten, so one transaction holds up to 500 symbols
+            if self._snapshots(snapshots_ref.stream(transaction=transaction))[0] != previous_watermark:
+                raise ValueError("Snapshots changed meanwhile")
+            for snapshot in snapshots:
+                transaction.set(snapshots_ref.document(snapshot["symbol"]), dict(snapshot, watermark=watermark))
+
+        save_transaction(self.client.transaction(), self._user_ref(user_id).collection("snapshots"))
+        self._reads(max(1, len(snapshots)))
+        self._writes(len(snapshots))
+
+    def user_ids(self):
+        for user_doc in self.client.collection("users").select([]).stream():
+            yield user_doc.id
+
+    # --- Maintenance ---
+
+    def backfill_positions(self):
+        @firestore.transactional
+        def backfill_user(transaction, user_doc_ref):
+            # The snapshots stand in for the history before their watermark
+            watermark, snapshots = self._snapshots(user_doc_ref.collection("snapshots").stream(transaction=transaction))
+            positions = {snapshot["symbol"]: dict(snapshot) for snapshot in snapshots}
+            history_query = user_doc_ref.collection("history")
+            if watermark is not None:
+                history_query = history_query.where(filter=firestore.FieldFilter("time", ">=", watermark))
+            for doc in history_query.stream(transaction=transaction):
+                item = doc.to_dict()
+                position = positions.setdefault(item["symbol"], {"symbol": item["symbol"], "shares": 0, "cost_basis": 0.0})
+                position["shares"] += item.get("shares", 0)
+                position["cost_basis"] += item.get("total", 0)
+            for symbol, position in positions.items():
+                position["updated_at"] = firestore.SERVER_TIMESTAMP
+                transaction.set(user_doc_ref.collection("positions").document(symbol), position)
+            return len(positions)
+
+        for user_id in list(self.user_ids()):
+            yield user_id, backfill_user(self.client.transaction(), self._user_ref(user_id))
+
+    def backfill_usernames(self):
+        # Usernames already indexed (e.g. claimed at registration) keep their user
+        owners = {doc.id: doc.get("user_id") for doc in self.client.collection("usernames").stream()}
+        batch = self.client.batch()
+        count = 0
+        duplicates = []
+        for user_doc in self.client.collection("users").stream():
+            username = user_doc.to_dict().get("username")
+            if not username:
+                continue
+            owner = owners.setdefault(username, user_doc.id)
+            if owner != user_doc.id:
+                # Overwriting would make the other account unreachable by login
+                duplicates.append((username, user_doc.id, owner))
+                continue
+            batch.set(self.client.collection("usernames").document(username), {"user_id": user_doc.id})
+            count += 1
+            if count % 500 == 0: # Firestore batches hold at most 500 writes
+                batch.commit()
+                batch = self.client.batch()
+        batch.commit()
+        return count, duplicates
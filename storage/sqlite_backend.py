@@ -0,0 +1,422 @@
+import datetime
+import sqlite3
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+
+from storage.base import AccountChange, Storage
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    hash TEXT NOT NULL,
+    cash REAL NOT NULL DEFAULT 0,
+    deposit REAL NOT NULL DEFAULT 0,
+    withdraw REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    symbol TEXT NOT NULL,
+    price REAL NOT NULL,
+    shares INTEGER NOT NULL,
+    total REAL NOT NULL,
+    type TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_by_time ON history (user_id, time, id);
+CREATE INDEX IF NOT EXISTS history_by_symbol ON history (user_id, symbol, time, id);
+CREATE INDEX IF NOT EXISTS history_by_type ON history (user_id, type, time, id);
+
+CREATE TABLE IF NOT EXISTS positions (
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    symbol TEXT NOT NULL,
+    shares INTEGER NOT NULL,
+    cost_basis REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, symbol)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    symbol TEXT NOT NULL,
+    side TEXT NOT NULL,
+    type TEXT NOT NULL,
+    shares INTEGER NOT NULL,
+    trigger_price REAL NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT,
+    filled_price REAL,
+    created_at REAL NOT NULL,
+    closed_at REAL
+);
+CREATE INDEX IF NOT EXISTS orders_by_user ON orders (user_id, status, id);
+CREATE INDEX IF NOT EXISTS orders_by_status ON orders (status, id);
+
+CREATE TABLE IF NOT EXISTS snapshots (
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    symbol TEXT NOT NULL,
+    shares INTEGER NOT NULL,
+    cost_basis REAL NOT NULL,
+    watermark REAL NOT NULL,
+    PRIMARY KEY (user_id, symbol)
+) WITHOUT ROWID;
+"""
+
+
+class SqliteStorage(Storage):
+    """SQLite backend for running the app locally or without Google credentials
+
+    Each thread gets its own connection to a WAL-mode database, so page
+    reads never wait on a trade being written.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode: transactions are opened explicitly below
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Run a block as one write transaction, taking the write lock up front"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _history_row(row):
+        history_row = dict(row)
+        history_row["id"] = str(row["id"])
+        history_row["time"] = datetime.datetime.fromtimestamp(row["time"], datetime.timezone.utc)
+        return history_row
+
+    def _locked_user(self, conn, user_id):
+        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        if row is None:
+            raise Exception("User not found during transaction")
+        return dict(row)
+
+    # --- Users ---
+
+    def get_user(self, user_id):
+        row = self._connection().execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        self._reads()
+        return dict(row) if row else None
+
+    def get_user_by_username(self, username):
+        row = self._connection().execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        self._reads()
+        return dict(row) if row else None
+
+    def create_user(self, username, password_hash):
+        user_id = uuid.uuid4().hex
+        try:
+            with self._transaction() as conn:
+                conn.execute("INSERT INTO users (id, username, hash, created_at) VALUES (?, ?, ?, ?)",
+                             (user_id, username, password_hash, time.time()))
+        except sqlite3.IntegrityError:
+            raise ValueError("Username already exists")
+        self._writes()
+        return user_id
+
+    def update_password_hash(self, user_id, password_hash):
+        with self._transaction() as conn:
+            conn.execute("UPDATE users SET hash = ? WHERE id = ?", (password_hash, user_id))
+        self._writes()
+
+    def delete_user(self, user_id):
+        # History, positions, orders and snapshots go with the user (ON DELETE CASCADE)
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        self._writes()
+
+    # --- Holdings and history ---
+
+    def get_positions(self, user_id):
+        rows = self._connection().execute(
+            "SELECT symbol, shares, cost_basis FROM positions WHERE user_id = ? AND shares > 0", (user_id,))
+        positions = [dict(row) for row in rows]
+        self._reads(len(positions))
+        return positions
+
+    def history_page(self, user_id, page_size, after=None, before=None, symbol=None, type=None):
+        conn = self._connection()
+        conditions = ["user_id = ?"]
+        params = [user_id]
+        if symbol:
+            conditions.append("symbol = ?")
+            params.append(symbol)
+        if type:
+            conditions.append("type = ?")
+            params.append(type)
+
+        cursor_id = after or before
+        if cursor_id:
+            cursor = conn.execute("SELECT time, id FROM history WHERE id = ? AND user_id = ?",
+                                  (cursor_id, user_id)).fetchone()
+            if cursor is None:
+                raise ValueError("Invalid page")
+            # Rows are ordered by (time, id), newest first
+            conditions.append("(time, id) < (?, ?)" if after else "(time, id) > (?, ?)")
+            params += [cursor["time"], cursor["id"]]
+
+        order = "ASC" if before else "DESC"
+        rows = conn.execute(
+            f"SELECT * FROM history WHERE {' AND '.join(conditions)} ORDER BY time {order}, id {order} LIMIT ?",
+            params + [page_size + 1]).fetchall()
+
+        self._reads(len(rows) + (1 if cursor_id else 0))
+        more = len(rows) > page_size
+        rows = [self._history_row(row) for row in rows[:page_size]]
+        if before:
+            rows.reverse()
+            return rows, more, True
+        return rows, bool(after), more
+
+    def iter_history(self, user_id, start=None, end=None, page_size=500):
+        conn = self._connection()
+        conditions = ["user_id = ?"]
+        params = [user_id]
+        if start is not None:
+            conditions.append("time >= ?")
+            params.append(start.timestamp())
+        if end is not None:
+            conditions.append("time < ?")
+            params.append(end.timestamp())
+
+        cursor = []
+        while True:
+            # Each page starts right after the last row of the previous one
+            page_conditions = conditions + (["(time, id) > (?, ?)"] if cursor else [])
+            rows = conn.execute(
+                f"SELECT * FROM history WHERE {' AND '.join(page_conditions)} ORDER BY time, id LIMIT ?",
+                params + cursor + [page_size]).fetchall()
+            self._reads(len(rows))
+            for row in rows:
+                yield self._history_row(row)
+            if len(rows) < page_size:
+                return
+            cursor = [rows[-1]["time"], rows[-1]["id"]]
+
+    # --- Transactions ---
+
+    def _record_trade(self, conn, user_id, symbol, price, shares, total, type):
+        now = time.time()
+        conn.execute("INSERT INTO history (user_id, symbol, price, shares, total, type, time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (user_id, symbol, price, shares, total, type, now))
+        conn.execute("INSERT INTO positions (user_id, symbol, shares, cost_basis, updated_at) VALUES (?, ?, ?, ?, ?) "
+                     "ON CONFLICT (user_id, symbol) DO UPDATE SET shares = shares + excluded.shares, "
+                     "cost_basis = cost_basis + excluded.cost_basis, updated_at = excluded.updated_at",
+                     (user_id, symbol, shares, total, now))
+
+    def buy(self, user_id, symbol, price, shares):
+        purchase_cost = price * shares
+        with self._transaction() as conn:
+            user = self._locked_user(conn, user_id)
+            current_cash = float(user["cash"])
+            if current_cash < purchase_cost:
+                raise ValueError("Insufficient balance")
+            new_cash = current_cash - purchase_cost
+            conn.execute("UPDATE users SET cash = ? WHERE id = ?", (new_cash, user_id))
+            self._record_trade(conn, user_id, symbol, price, shares, purchase_cost, "buy")
+        self._reads(2)
+        self._writes(3)
+        return AccountChange(user, dict(user, cash=new_cash))
+
+    def sell(self, user_id, symbol, price, shares):
+        sale_proceeds = price * shares
+        with self._transaction() as conn:
+            position = conn.execute("SELECT shares FROM positions WHERE user_id = ? AND symbol = ?",
+                                    (user_id, symbol)).fetchone()
+            if (position["shares"] if position else 0) < shares:
+                raise ValueError("Insufficient shares")
+            user = self._locked_user(conn, user_id)
+            new_cash = float(user["cash"]) + sale_proceeds
+            conn.execute("UPDATE users SET cash = ? WHERE id = ?", (new_cash, user_id))
+            self._record_trade(conn, user_id, symbol, price, -shares, -sale_proceeds, "sell")
+        self._reads(2)
+        self._writes(3)
+        return AccountChange(user, dict(user, cash=new_cash))
+
+    def _trade(self, conn, user_id, legs):
+        """Check and record trade legs inside a transaction and return the AccountChange"""
+        symbols = list(dict.fromkeys(symbol for symbol, price, shares in legs))
+        user = self._locked_user(conn, user_id)
+        held = {symbol: 0 for symbol in symbols}
+        for row in conn.execute(f"SELECT symbol, shares FROM positions WHERE user_id = ? AND symbol IN "
+                                f"({', '.join('?' * len(symbols))})", (user_id, *symbols)):
+            held[row["symbol"]] = row["shares"]
+        new_cash = float(user["cash"])
+        for symbol, price, shares in legs:
+            held[symbol] += shares
+            new_cash -= price * shares
+        if any(shares < 0 for shares in held.values()):
+            raise ValueError("Insufficient shares")
+        if new_cash < 0:
+            raise ValueError("Insufficient balance")
+        conn.execute("UPDATE users SET cash = ? WHERE id = ?", (new_cash, user_id))
+        for symbol, price, shares in legs:
+            self._record_trade(conn, user_id, symbol, price, shares, price * shares, "buy" if shares > 0 else "sell")
+        self._reads(1 + len(symbols))
+        self._writes(1 + 2 * len(legs))
+        return AccountChange(user, dict(user, cash=new_cash))
+
+    def trade(self, user_id, legs):
+        with self._transaction() as conn:
+            return self._trade(conn, user_id, legs)
+
+    def deposit(self, user_id, amount):
+        with self._transaction() as conn:
+            user = self._locked_user(conn, user_id)
+            new_cash = float(user["cash"]) + amount
+            new_deposit_total = float(user["deposit"]) + amount
+            conn.execute("UPDATE users SET cash = ?, deposit = ? WHERE id = ?", (new_cash, new_deposit_total, user_id))
+        self._reads()
+        self._writes()
+        return AccountChange(user, dict(user, cash=new_cash, deposit=new_deposit_total))
+
+    def withdraw(self, user_id, amount):
+        with self._transaction() as conn:
+            user = self._locked_user(conn, user_id)
+            current_cash = float(user["cash"])
+            if current_cash < amount:
+                raise ValueError("Insufficient balance for withdrawal")
+            new_cash = current_cash - amount
+            new_withdraw_total = float(user["withdraw"]) + amount
+            conn.execute("UPDATE users SET cash = ?, withdraw = ? WHERE id = ?", (new_cash, new_withdraw_total, user_id))
+        self._reads()
+        self._writes()
+        return AccountChange(user, dict(user, cash=new_cash, withdraw=new_withdraw_total))
+
+    # --- Resting orders ---
+
+    @staticmethod
+    def _order(row):
+        order = dict(row)
+        order["id"] = str(row["id"])
+        order["created_at"] = datetime.datetime.fromtimestamp(row["created_at"], datetime.timezone.utc)
+        return order
+
+    def place_order(self, user_id, symbol, side, type, shares, trigger_price):
+        with self._transaction() as conn:
+            row = conn.execute("INSERT INTO orders (user_id, symbol, side, type, shares, trigger_price, status, created_at) "
+                               "VALUES (?, ?, ?, ?, ?, ?, 'open', ?) RETURNING *",
+                               (user_id, symbol, side, type, shares, trigger_price, time.time())).fetchone()
+        self._writes()
+        return self._order(row)
+
+    def get_orders(self, user_id):
+        rows = self._connection().execute("SELECT * FROM orders WHERE user_id = ? AND status = 'open' ORDER BY id",
+                                          (user_id,)).fetchall()
+        self._reads(len(rows))
+        return [self._order(row) for row in rows]
+
+    def open_orders(self):
+        for row in self._connection().execute("SELECT * FROM orders WHERE status = 'open' ORDER BY id"):
+            self._reads()
+            yield self._order(row)
+
+    def _close_order(self, conn, user_id, order_id, status, **fields):
+        # Only an open order can be closed, and only once
+        assignments = "".join(f", {field} = ?" for field in fields)
+        return conn.execute(f"UPDATE orders SET status = ?, closed_at = ?{assignments} "
+                            f"WHERE id = ? AND user_id = ? AND status = 'open'",
+                            (status, time.time(), *fields.values(), order_id, user_id)).rowcount
+
+    def cancel_order(self, user_id, order_id):
+        with self._transaction() as conn:
+            if not self._close_order(conn, user_id, order_id, "cancelled"):
+                raise ValueError("Order not found")
+        self._writes()
+
+    def fill_order(self, user_id, order_id, price):
+        with self._transaction() as conn:
+            order = conn.execute("SELECT * FROM orders WHERE id = ? AND user_id = ? AND status = 'open'",
+                                 (order_id, user_id)).fetchone()
+            if order is None:
+                raise ValueError("Order is not open")
+            shares = order["shares"] if order["side"] == "buy" else -order["shares"]
+            change = self._trade(conn, user_id, [(order["symbol"], price, shares)])
+            self._close_order(conn, user_id, order_id, "filled", filled_price=price)
+        self._reads()
+        self._writes()
+        return change
+
+    def reject_order(self, user_id, order_id, reason):
+        with self._transaction() as conn:
+            self._close_order(conn, user_id, order_id, "rejected", reason=reason)
+        self._writes()
+
+    # --- History snapshots ---
+
+    @staticmethod
+    def _watermark(conn, user_id):
+        watermark = conn.execute("SELECT MAX(watermark) FROM snapshots WHERE user_id = ?", (user_id,)).fetchone()[0]
+        return None if watermark is None else datetime.datetime.fromtimestamp(watermark, datetime.timezone.utc)
+
+    def get_snapshots(self, user_id):
+        conn = self._connection()
+        snapshots = [dict(row) for row in conn.execute(
+            "SELECT symbol, shares, cost_basis FROM snapshots WHERE user_id = ?", (user_id,))]
+        self._reads(len(snapshots))
+        return self._watermark(conn, user_id), snapshots
+
+    def save_snapshots(self, user_id, previous_watermark, watermark, snapshots):
+        with self._transaction() as conn:
+            if self._watermark(conn, user_id) != previous_watermark:
+                raise ValueError("Snapshots changed meanwhile")
+            conn.execute("DELETE FROM snapshots WHERE user_id = ?", (user_id,))
+            conn.executemany("INSERT INTO snapshots (user_id, symbol, shares, cost_basis, watermark) VALUES (?, ?, ?, ?, ?)",
+                             [(user_id, snapshot["symbol"], snapshot["shares"], snapshot["cost_basis"], watermark.timestamp())
+                              for snapshot in snapshots])
+        self._writes(len(snapshots))
+
+    def user_ids(self):
+        for row in self._connection().execute("SELECT id FROM users"):
+            yield row["id"]
+
+    # --- Maintenance ---
+
+    def backfill_positions(self):
+        for user_id in list(self.user_ids()):
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM positions WHERE user_id = ?", (user_id,))
+                # The snapshots stand in for the history rows before their watermark
+                count = conn.execute(
+                    "INSERT INTO positions (user_id, symbol, shares, cost_basis, updated_at) "
+                    "SELECT ?, symbol, SUM(shares), SUM(total), ? FROM ("
+                    "SELECT symbol, shares, cost_basis AS total FROM snapshots WHERE user_id = ? UNION ALL "
+                    "SELECT symbol, shares, total FROM history WHERE user_id = ? "
+                    "AND time >= (SELECT COALESCE(MAX(watermark), 0) FROM snapshots WHERE user_id = ?)) GROUP BY symbol",
+                    (user_id, time.time(), user_id, user_id, user_id)).rowcount
+            yield user_id, count
+
+    def backfill_usernames(self):
+        # Usernames are a unique column here, so there is no separate index to build (nor duplicates)
+        return self._connection().execute("SELECT COUNT(*) FROM users").fetchone()[0], []
@@ -0,0 +1,60 @@
+"""Per-request unit of work over the storage backend
+
+A request reads each user document at most once: the unit of work keeps
+every user it has read or written (an identity map), and trades and cash
+operations leave behind the user exactly as their transaction wrote it.
+Each read it answers itself is counted per route on the metrics endpoint.
+"""
+
+from metrics import count_saved_read
+
+
+class UnitOfWork:
+    """Read users through the storage backend once per request
+
+    Create one per request and drop it at the end, so nothing read here
+    outlives the request.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._users = {} # user ID -> user dict, or None if there is no such user
+
+    def get_user(self, user_id):
+        """Return the user with this ID, or None, reading it only the first time"""
+        if user_id in self._users:
+            count_saved_read()
+            return self._users[user_id]
+        user = self._users[user_id] = self.storage.get_user(user_id)
+        return user
+
+    def get_user_by_username(self, username):
+        user = self.storage.get_user_by_username(username)
+        if user is not None:
+            self._users[user["id"]] = user
+        return user
+
+    def forget(self, user_id):
+        """Drop a user that was changed other than through this unit of work"""
+        self._users.pop(user_id, None)
+
+    def _changed(self, user_id, change):
+        self._users[user_id] = change.after
+        return change
+
+    # Trades and cash operations return the AccountChange, i.e. the balances before and after
+
+    def buy(self, user_id, symbol, price, shares):
+        return self._changed(user_id, self.storage.buy(user_id, symbol, price, shares))
+
+    def sell(self, user_id, symbol, price, shares):
+        return self._changed(user_id, self.storage.sell(user_id, symbol, price, shares))
+
+    def trade(self, user_id, legs):
+        return self._changed(user_id, self.storage.trade(user_id, legs))
+
+    def deposit(self, user_id, amount):
+        return self._changed(user_id, self.storage.deposit(user_id, amount))
+
+    def withdraw(self, user_id, amount):
+        return self._changed(user_id, self.storage.withdraw(user_id, amount))
@@ -0,0 +1,88 @@
+"""Local index of known stock symbols for validation and autocomplete
+
+The index is read from a CSV file (symbol,name) the first time it is
+used and kept as sorted tuples, so prefix searches are a binary search
+and need no network calls. Point SYMBOLS_PATH at a full exchange listing
+to replace the bundled list of common symbols.
+"""
+
+import bisect
+import csv
+import os
+import threading
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+SYMBOLS_PATH = os.getenv("SYMBOLS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "symbols.csv"))
+# Set to 1 to reject every symbol missing from the index (only sensible with a full listing)
+SYMBOL_INDEX_STRICT = os.getenv("SYMBOL_INDEX_STRICT", "0") == "1"
+# Most suggestions returned by one autocomplete search
+SYMBOL_SEARCH_LIMIT = int(os.getenv("SYMBOL_SEARCH_LIMIT", "10"))
+
+
+class SymbolIndex:
+    """Sorted, lazily loaded index of symbols and company names"""
+
+    def __init__(self, path):
+        self.path = path
+        self._symbols = None # sorted symbols
+        self._names = None # company name of each symbol, same order
+        self._name_keys = None # sorted (lowercase name, position) pairs
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._symbols is not None:
+                return
+            try:
+                with open(self.path, newline="", encoding="utf-8") as f:
+                    rows = sorted({row["symbol"].strip().upper(): row["name"].strip()
+                                   for row in csv.DictReader(f) if row.get("symbol")}.items())
+            except OSError:
+                print(f"WARNING: Symbol index {self.path} could not be read, autocomplete is disabled")
+                rows = []
+            self._names = tuple(name for symbol, name in rows)
+            self._name_keys = tuple(sorted((name.lower(), i) for i, name in enumerate(self._names)))
+            self._symbols = tuple(symbol for symbol, name in rows)
+
+    def __len__(self):
+        self._load()
+        return len(self._symbols)
+
+    def __contains__(self, symbol):
+        self._load()
+        i = bisect.bisect_left(self._symbols, symbol)
+        return i < len(self._symbols) and self._symbols[i] == symbol
+
+    def search(self, query, limit=SYMBOL_SEARCH_LIMIT):
+        """Return up to limit {"symbol", "name"} matches, symbol prefix matches first, then name prefix matches"""
+        self._load()
+        query = query.strip()
+        if not query:
+            return []
+
+        matches = []
+        prefix = query.upper()
+        i = bisect.bisect_left(self._symbols, prefix)
+        while i < len(self._symbols) and len(matches) < limit and self._symbols[i].startswith(prefix):
+            matches.append(i)
+            i += 1
+
+        prefix = query.lower()
+        j = bisect.bisect_left(self._name_keys, (prefix,))
+        while j < len(self._name_keys) and len(matches) < limit and self._name_keys[j][0].startswith(prefix):
+            if self._name_keys[j][1] not in matches:
+                matches.append(self._name_keys[j][1])
+            j += 1
+
+        return [{"symbol": self._symbols[i], "name": self._names[i]} for i in matches]
+
+
+symbol_index = SymbolIndex(SYMBOLS_PATH)
+
+
+def known_symbol(symbol):
+    """Return whether symbol may exist: always, unless strict mode is on and it is missing from the index"""
+    return not SYMBOL_INDEX_STRICT or symbol in symbol_index